@@ -3,48 +3,204 @@
 from flask import Flask, request, redirect, render_template
 from flask import jsonify, url_for, flash, abort, g
 from flask import session as login_session
-from flask import make_response
+from flask import make_response, Response, stream_with_context
+from flask import json as flask_json
+from flask import has_request_context
 from flask_httpauth import HTTPBasicAuth
 
 # importing from database
-from sqlalchemy import create_engine, asc
-from sqlalchemy import func
-from sqlalchemy.orm import sessionmaker
-from models import Base, Department, Employee, Education, Company
+from sqlalchemy import asc, and_, or_
+from sqlalchemy import func, text, case, literal, exists, select
+from sqlalchemy import event, Date
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import sessionmaker, scoped_session, selectinload
+from models import Department, Employee, Education, Company
 from models import Emergency, Onboardinglist, Onboarding
 from models import Note, Traininglist, Training, CompanyLinks
-from models import Documents, User, Patient
+from models import Documents, User, Patient, linking_members
+from models import get_engine, configure_engine, init_db, signing_keys
+from passwords import PasswordBusy
+import serializers
+import jobs
+import metrics
 
 
 from flask_login import LoginManager, UserMixin, login_required, login_user
 from flask_login import logout_user
 from werkzeug.utils import secure_filename
 
-import random, string, json, time
+import json, time
+import csv, io, datetime, re, hashlib, base64
+import threading
+from collections import OrderedDict, Counter
+from contextlib import contextmanager
+import click
 
 from redis import Redis
+from redis.exceptions import RedisError
 from functools import update_wrapper
 
-# database config
-from config import DB_USER, DB_PASSWORD, DB_END, DB_PORT, DB_DATABASE
+# config, the database settings are read by models.get_engine
+import config
+
+# list endpoints config
+PAGE_LIMIT = getattr(config, 'PAGE_LIMIT', 100)
+PAGE_MAX_LIMIT = getattr(config, 'PAGE_MAX_LIMIT', 1000)
+STREAM_CHUNK_SIZE = getattr(config, 'STREAM_CHUNK_SIZE', 1000)
+# tuple rows + orjson for list endpoints, per request with ?fast=1
+FAST_SERIALIZER = getattr(config, 'FAST_SERIALIZER', False)
+
+# search config, shorter words than the fulltext token size use prefix LIKE
+SEARCH_LIMIT = getattr(config, 'SEARCH_LIMIT', 20)
+SEARCH_MAX_LIMIT = getattr(config, 'SEARCH_MAX_LIMIT', 100)
+SEARCH_MIN_TOKEN = getattr(config, 'SEARCH_MIN_TOKEN', 3)
+
+# reports config, snapshots are kept in redis for REPORT_SNAPSHOT_TTL seconds
+REPORT_SNAPSHOTS = getattr(config, 'REPORT_SNAPSHOTS', True)
+REPORT_SNAPSHOT_TTL = getattr(config, 'REPORT_SNAPSHOT_TTL', 900)
+
+# compliance config, the daily digest lists what expires within DIGEST_DAYS
+COMPLIANCE_DIGEST_DAYS = getattr(config, 'COMPLIANCE_DIGEST_DAYS', 30)
+COMPLIANCE_MAX_WITHIN = getattr(config, 'COMPLIANCE_MAX_WITHIN', 3650)
+COMPLIANCE_DIGEST_TTL = getattr(config, 'COMPLIANCE_DIGEST_TTL', 2*24*3600)
+
+# background jobs config
+JOB_TTL = getattr(config, 'JOB_TTL', 24*3600)
+JOB_MAX_RETRIES = getattr(config, 'JOB_MAX_RETRIES', 3)
+JOB_LOCAL_WORKERS = getattr(config, 'JOB_LOCAL_WORKERS', 2)
+# a job reporting no progress for this long is taken as lost with its worker
+JOB_STALE_AFTER = getattr(config, 'JOB_STALE_AFTER', 600)
+
+# instrumentation config, nothing is hooked in when both are off
+METRICS_ENABLED = getattr(config, 'METRICS_ENABLED', False)
+SERVER_TIMING = getattr(config, 'SERVER_TIMING', False)
+# profiling: log statements slower than SLOW_QUERY_MS and requests that
+# repeat one statement shape NPLUSONE_THRESHOLD times or more
+SQL_PROFILE = getattr(config, 'SQL_PROFILE', False)
+SLOW_QUERY_MS = getattr(config, 'SLOW_QUERY_MS', 100)
+NPLUSONE_THRESHOLD = getattr(config, 'NPLUSONE_THRESHOLD', 5)
+NPLUSONE_RAISE = getattr(config, 'NPLUSONE_RAISE', False)
+
+# bulk import config
+BULK_BATCH_SIZE = getattr(config, 'BULK_BATCH_SIZE', 500)
+BULK_MAX_ROWS = getattr(config, 'BULK_MAX_ROWS', 10000)
+
+# reference data cache config
+CACHE_ENABLED = getattr(config, 'CACHE_ENABLED', True)
+CACHE_TTL = getattr(config, 'CACHE_TTL', 300)
+# etags of whole tables, from the same redis generations
+TABLE_ETAGS = getattr(config, 'TABLE_ETAGS', True)
+
+# authenticated user cache config
+AUTH_CACHE_SIZE = getattr(config, 'AUTH_CACHE_SIZE', 1024)
+AUTH_CACHE_TTL = getattr(config, 'AUTH_CACHE_TTL', 30)
+AUTH_CACHE_REDIS = getattr(config, 'AUTH_CACHE_REDIS', False)
+AUTH_CACHE_REDIS_TTL = getattr(config, 'AUTH_CACHE_REDIS_TTL', 300)
+
+# rate limit config, engine is 'fixed', 'sliding' or 'memory'
+RATELIMIT_ENGINE = getattr(config, 'RATELIMIT_ENGINE', 'fixed')
+RATELIMIT_PRECHECK_RATIO = getattr(config, 'RATELIMIT_PRECHECK_RATIO', 0.5)
+RATELIMIT_PRECHECK_SYNC = getattr(config, 'RATELIMIT_PRECHECK_SYNC', 1.0)
+RATELIMIT_PRECHECK_KEYS = getattr(config, 'RATELIMIT_PRECHECK_KEYS', 10000)
+# processes sharing the redis limits, the pre-check splits the budget
+RATELIMIT_WORKERS = getattr(config, 'RATELIMIT_WORKERS', 1)
+RATELIMIT_MEMORY_KEYS = getattr(config, 'RATELIMIT_MEMORY_KEYS', 100000)
+RATELIMIT_MEMORY_IDLE = getattr(config, 'RATELIMIT_MEMORY_IDLE', 3600)
+RATELIMIT_BREAKER_FAILURES = getattr(config, 'RATELIMIT_BREAKER_FAILURES', 5)
+RATELIMIT_BREAKER_RESET = getattr(config, 'RATELIMIT_BREAKER_RESET', 30)
+
+# redis config, short timeouts so a slow redis cannot stall requests
+REDIS_SOCKET_TIMEOUT = getattr(config, 'REDIS_SOCKET_TIMEOUT', 0.25)
+REDIS_CONNECT_TIMEOUT = getattr(config, 'REDIS_CONNECT_TIMEOUT', 0.25)
 
 
 # initialisation
 app = Flask(__name__)
+# same key on every worker, see SECRET_KEYS in models.signing_keys
+app.config['SECRET_KEY'] = signing_keys()[0]
 auth = HTTPBasicAuth()
-engine=create_engine('mysql+pymysql://'+DB_USER+':'+DB_PASSWORD+'@'+DB_END+':'+DB_PORT+'/'
-                     +DB_DATABASE)
-Base.metadata.bin = engine
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
-redis = Redis()
+DBSession = sessionmaker()
+# one session per thread/request, released in shutdown_session; the
+# shared engine is only created when a session first needs it
+session = scoped_session(lambda: DBSession(bind=get_engine()))
+redis = Redis(socket_timeout=REDIS_SOCKET_TIMEOUT,
+              socket_connect_timeout=REDIS_CONNECT_TIMEOUT)
+
+
+# background jobs run in an app context with their own session
+@contextmanager
+def job_context():
+    with app.app_context():
+        try:
+            yield
+        except:
+            session.rollback()
+            raise
+        finally:
+            session.remove()
+
+job_queue = jobs.JobQueue(redis, job_context, ttl=JOB_TTL,
+                          max_retries=JOB_MAX_RETRIES,
+                          local_workers=JOB_LOCAL_WORKERS, logger=app.logger,
+                          stale_after=JOB_STALE_AFTER)
+
+
+# end of request: keep or drop the pending work, then give the
+# connection back to the pool
+@app.teardown_request
+def shutdown_session(exception=None):
+    try:
+        if exception is None:
+            session.commit()
+        else:
+            session.rollback()
+    except Exception:
+        app.logger.exception('could not commit session')
+        session.rollback()
+    finally:
+        session.remove()
+
+
+# small thread-safe LRU with expiry, for per-process caches
+class LRUCache(object):
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                return None
+            if item[0] < time.time():
+                del self.items[key]
+                return None
+            self.items.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value):
+        with self.lock:
+            self.items[key] = (time.time() + self.ttl, value)
+            self.items.move_to_end(key)
+            while len(self.items) > self.size:
+                self.items.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.items.pop(key, None)
 
 
 # control the usage of the api
+# every engine takes (key_prefix, limit, per, send_x_headers, precheck) and
+# exposes limit, remaining, reset, send_x_headers and over_limit
 class RateLimit(object):
     expiration_window = 10
 
-    def __init__(self, key_prefix, limit, per, send_x_headers):
+    def __init__(self, key_prefix, limit, per, send_x_headers, precheck=False):
+        # fixed window, precheck is not supported
         self.reset = (int(time.time()) // per) * per + per
         self.key = key_prefix + str(self.reset)
         self.limit = limit
@@ -58,6 +214,197 @@ class RateLimit(object):
     remaining = property(lambda x: x.limit - x.current)
     over_limit = property(lambda x: x.current >= x.limit)
 
+
+# sliding window counter: the previous window is weighted by how much of
+# it still overlaps the last `per` seconds, so there is no 2x burst at the
+# window boundary. Requests already let through by the local pre-check
+# are added first, then the current one is counted if it fits.
+SLIDING_WINDOW_SCRIPT = """
+local limit = tonumber(ARGV[1])
+local elapsed = tonumber(ARGV[2])
+local pending = tonumber(ARGV[3])
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+local previous = tonumber(redis.call('GET', KEYS[2]) or '0')
+if pending > 0 then
+    current = redis.call('INCRBY', KEYS[1], pending)
+end
+local weighted = previous * (1 - elapsed) + current
+local allowed = 0
+if weighted < limit then
+    current = redis.call('INCR', KEYS[1])
+    weighted = weighted + 1
+    allowed = 1
+end
+redis.call('EXPIRE', KEYS[1], ARGV[4])
+return {math.ceil(weighted), allowed}
+"""
+sliding_window = redis.register_script(SLIDING_WINDOW_SCRIPT)
+
+# per process view of each key:
+# [last sync, remaining, let through since, local allowance]
+precheck_state = LRUCache(RATELIMIT_PRECHECK_KEYS, 3600)
+precheck_lock = threading.Lock()
+
+
+class SlidingWindowRateLimit(object):
+    expiration_window = 10
+
+    def __init__(self, key_prefix, limit, per, send_x_headers, precheck=False):
+        now = time.time()
+        window = int(now) // per
+        self.reset = window * per + per
+        self.limit = limit
+        self.per = per
+        self.send_x_headers = send_x_headers
+        self.key_prefix = key_prefix
+        if precheck and self.precheck(now):
+            return
+        pending = self.take_pending() if precheck else 0
+        # one round trip, EVALSHA with a fallback to EVAL on a cold server
+        try:
+            weighted, allowed = sliding_window(
+                keys=[key_prefix + str(window), key_prefix + str(window - 1)],
+                args=[limit, (now - window * per) / float(per), pending,
+                      per * 2 + self.expiration_window])
+        except RedisError:
+            self.return_pending(pending)
+            raise
+        self.current = min(weighted, limit)
+        self.allowed = bool(allowed)
+        if precheck:
+            self.store_precheck(now)
+
+    def store_precheck(self, now):
+        # the budget above the reserve is split between the processes so
+        # together they never let through more than the limit; hits let
+        # through while this sync was running are kept for the next one
+        spare = self.remaining - self.limit * RATELIMIT_PRECHECK_RATIO
+        allowance = int(max(0, spare) / max(RATELIMIT_WORKERS, 1))
+        with precheck_lock:
+            state = precheck_state.get(self.key_prefix)
+            pending = state[2] if state is not None else 0
+            precheck_state.set(self.key_prefix,
+                               [now, self.remaining, pending, allowance])
+
+    def precheck(self, now):
+        # let the caller through without redis while this process has some
+        # of its share of the budget left, the skipped hits are sent on the
+        # next sync
+        with precheck_lock:
+            state = precheck_state.get(self.key_prefix)
+            if state is None or now - state[0] > RATELIMIT_PRECHECK_SYNC:
+                return False
+            if state[2] >= state[3]:
+                return False
+            state[2] += 1
+            self.current = self.limit - (state[1] - state[2])
+            self.allowed = True
+            return True
+
+    def take_pending(self):
+        with precheck_lock:
+            state = precheck_state.get(self.key_prefix)
+            if state is None:
+                return 0
+            pending, state[2] = state[2], 0
+            return pending
+
+    def return_pending(self, pending):
+        # redis failed, keep the hits for the next sync
+        with precheck_lock:
+            state = precheck_state.get(self.key_prefix)
+            if state is not None:
+                state[2] += pending
+
+    remaining = property(lambda x: x.limit - x.current)
+    over_limit = property(lambda x: not x.allowed)
+
+
+# in process token bucket, for single node deployments and as the fallback
+# when redis fails. Idle buckets are evicted, a bucket left alone for
+# RATELIMIT_MEMORY_IDLE seconds would be full again anyway.
+memory_buckets = LRUCache(RATELIMIT_MEMORY_KEYS, RATELIMIT_MEMORY_IDLE)
+memory_buckets_lock = threading.Lock()
+
+
+class MemoryRateLimit(object):
+
+    def __init__(self, key_prefix, limit, per, send_x_headers, precheck=False):
+        now = time.time()
+        rate = float(limit) / per
+        with memory_buckets_lock:
+            bucket = memory_buckets.get(key_prefix)
+            if bucket is None:
+                bucket = [float(limit), now]
+            tokens = min(float(limit), bucket[0] + (now - bucket[1]) * rate)
+            self.allowed = tokens >= 1
+            if self.allowed:
+                tokens -= 1
+            bucket[0], bucket[1] = tokens, now
+            memory_buckets.set(key_prefix, bucket)
+        self.limit = limit
+        self.per = per
+        self.send_x_headers = send_x_headers
+        self.current = limit - int(tokens)
+        # when the bucket is full again
+        self.reset = int(now + (limit - tokens) / rate)
+
+    remaining = property(lambda x: x.limit - x.current)
+    over_limit = property(lambda x: not x.allowed)
+
+
+RATELIMIT_ENGINES = {
+    'fixed':RateLimit,
+    'sliding':SlidingWindowRateLimit,
+    'memory':MemoryRateLimit
+    }
+
+
+# stop calling redis for a while after repeated failures
+class CircuitBreaker(object):
+
+    def __init__(self, failures, reset_timeout):
+        self.failures = failures
+        self.reset_timeout = reset_timeout
+        self.count = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            # half open: let one call through to probe redis
+            if time.time() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.count = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.count += 1
+            if self.count >= self.failures:
+                self.opened_at = time.time()
+
+redis_breaker = CircuitBreaker(RATELIMIT_BREAKER_FAILURES, RATELIMIT_BREAKER_RESET)
+
+def get_rate_limit(engine, key_prefix, limit, per, send_x_headers, precheck):
+    if engine != 'memory' and redis_breaker.allow():
+        try:
+            rlimit = RATELIMIT_ENGINES[engine](key_prefix, limit, per,
+                                               send_x_headers, precheck)
+            redis_breaker.record_success()
+            return rlimit
+        except RedisError as e:
+            redis_breaker.record_failure()
+            app.logger.warning('rate limit falls back to memory: %s' %e)
+    return MemoryRateLimit(key_prefix, limit, per, send_x_headers)
+
 def get_view_rate_limit():
     return getattr(g, '_view_rate_limit', None)
 
@@ -67,13 +414,23 @@ def on_over_limit(limit):
 def ratelimit(limit, per=300, send_x_headers=True,
               over_limit=on_over_limit,
               scope_func=lambda: request.remote_addr,
-              key_func=lambda: request.endpoint):
+              key_func=lambda: request.endpoint,
+              engine=None, precheck=False):
+    # engine: 'fixed' (redis pipeline), 'sliding' (redis lua script) or
+    # 'memory' (in process token bucket); the redis engines fall back to
+    # memory when redis fails. precheck only applies to the sliding engine
+    engine = engine or RATELIMIT_ENGINE
+    if engine not in RATELIMIT_ENGINES:
+        raise ValueError('unknown rate limit engine %s' %engine)
     def decorator(f):
         def rate_limited(*args, **kwargs):
             key = 'rate-limit/%s/%s/' % (key_func(), scope_func())
-            rlimit = RateLimit(key, limit, per, send_x_headers)
+            rlimit = get_rate_limit(engine, key, limit, per,
+                                    send_x_headers, precheck)
             g._view_rate_limit = rlimit
             if over_limit is not None and rlimit.over_limit:
+                if METRICS_ENABLED:
+                    ratelimit_rejections.inc(request.endpoint)
                 return over_limit(rlimit)
             return f(*args, **kwargs)
         return update_wrapper(rate_limited, f)
@@ -91,13 +448,520 @@ def inject_x_rate_headers(response):
     return response
 
 
+# list endpoints: keyset pagination on id, or NDJSON streaming
+def page_limit():
+    limit = request.args.get('limit', PAGE_LIMIT, type=int)
+    if limit is None or limit < 1:
+        abort(400)
+    return min(limit, PAGE_MAX_LIMIT)
+
+def stream_rows(query):
+    # yield_per + server side cursor keep memory flat whatever the table size
+    rows = query.execution_options(stream_results=True).yield_per(STREAM_CHUNK_SIZE)
+    for row in rows:
+        yield flask_json.dumps(row.serialize) + '\n'
+
+def stream_tuples(names, query, dumps):
+    rows = query.execution_options(stream_results=True).yield_per(STREAM_CHUNK_SIZE)
+    for row in rows:
+        yield dumps(dict(zip(names, row))) + b'\n'
+
+def flask_dumps(obj):
+    return flask_json.dumps(obj).encode('utf-8')
+
+def use_fast_serializer(model):
+    fast = request.args.get('fast')
+    if fast is None:
+        return FAST_SERIALIZER and serializers.supports(model)
+    return fast not in ('0', 'false') and serializers.supports(model)
+
+def requested_fields(model):
+    # ?fields=a,b restricts both the SELECT and the output, id is always kept
+    fields = request.args.get('fields')
+    if not fields or not serializers.supports(model):
+        return None
+    names = ['id'] + [f.strip() for f in fields.split(',')
+                      if f.strip() and f.strip() != 'id']
+    known = serializers.column_names(model)
+    if any(name not in known for name in names):
+        abort(400)
+    return names
+
+def serialized_rows(model, query):
+    # list of serialized rows of query, honouring ?fields=
+    fields = requested_fields(model)
+    if fields is None:
+        return [i.serialize for i in query]
+    names, query = serializers.select_serialized(query, model, fields)
+    return serializers.rows_to_dicts(names, query)
+
+def serialized_row(model, id):
+    # one serialized row, only the ?fields= columns are read
+    names, query = serializers.select_serialized(
+        session.query(model).filter_by(id=id), model, requested_fields(model))
+    row = query.first()
+    if row is None:
+        abort(404)
+    return dict(zip(names, row))
+
+def tuple_list_response(name, model, query, fields, fast, sort_column=None):
+    names, query = serializers.select_serialized(query, model, fields)
+    if sort_column is not None:
+        # read after the serialized columns for the cursor, zip drops it
+        query = query.add_columns(sort_column)
+    dumps = serializers.dumps if fast else flask_dumps
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(stream_tuples(names, query, dumps)),
+                        mimetype='application/x-ndjson')
+    limit = page_limit()
+    rows = query.limit(limit + 1).all()
+    next_after = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_after = (last[0] if sort_column is None
+                      else encode_cursor(last[-1], last[0]))
+    return Response(dumps({name: serializers.rows_to_dicts(names, rows[:limit]),
+                           'next': next_after}), mimetype='application/json')
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        abort(400)
+
+def encode_cursor(value, id):
+    # sort value and id of the last row of a sorted page, so the next page
+    # does not depend on that row still being there
+    if isinstance(value, datetime.date):
+        value = value.isoformat()
+    data = json.dumps([value, id])
+    return base64.urlsafe_b64encode(data.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(cursor, column):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        value, id = json.loads(data.decode('utf-8'))
+        if value is not None and isinstance(column.type, Date):
+            value = datetime.datetime.strptime(value, '%Y-%m-%d').date()
+        return value, int(id)
+    except (TypeError, ValueError):
+        abort(400)
+
+def sorted_after(query, model, column, descending, value, after):
+    # keyset on (column, id): rows that come after (value, after) in the
+    # sort order, nulls sort first ascending and last descending
+    if descending:
+        if value is None:
+            return query.filter(column.is_(None), model.id < after)
+        return query.filter(or_(column < value, column.is_(None),
+                                and_(column == value, model.id < after)))
+    if value is None:
+        return query.filter(or_(column.isnot(None),
+                                and_(column.is_(None), model.id > after)))
+    return query.filter(or_(column > value,
+                            and_(column == value, model.id > after)))
+
+def list_response(name, model, query=None, sortable=None):
+    # ?after=<cursor>&limit=<n> returns one page and the cursor of the next
+    # one, an id or with ?sort= an opaque (value, id) cursor,
+    # ?format=ndjson streams every row one json document per line,
+    # ?sort=<name> or ?sort=-<name> orders by one of the sortable columns
+    if query is None:
+        query = session.query(model)
+    column = None
+    sort = request.args.get('sort')
+    if sort:
+        descending = sort.startswith('-')
+        column = (sortable or {}).get(sort.lstrip('-'))
+        if column is None:
+            abort(400)
+        after = request.args.get('after')
+        if after:
+            value, after = decode_cursor(after, column)
+            query = sorted_after(query, model, column, descending, value, after)
+        if descending:
+            query = query.order_by(column.desc(), model.id.desc())
+        else:
+            query = query.order_by(column, model.id)
+    else:
+        after = request.args.get('after', type=int)
+        if after is not None:
+            query = query.filter(model.id > after)
+        query = query.order_by(model.id)
+    fields = requested_fields(model)
+    fast = use_fast_serializer(model)
+    if fields is not None or fast:
+        return tuple_list_response(name, model, query, fields, fast, column)
+    if request.args.get('format') == 'ndjson':
+        return Response(stream_with_context(stream_rows(query)),
+                        mimetype='application/x-ndjson')
+    limit = page_limit()
+    rows = query.limit(limit + 1).all()
+    next_after = None
+    if len(rows) > limit:
+        last = rows[limit - 1]
+        next_after = (last.id if column is None
+                      else encode_cursor(getattr(last, column.key), last.id))
+    return jsonify(**{name: [i.serialize for i in rows[:limit]],
+                      'next': next_after})
+
+
+# read-through cache for the small reference tables; every table has a
+# generation number in redis, bumping it on a write orphans the old entries
+cache_stats = {'hits':0, 'misses':0, 'errors':0}
+cache_stats_lock = threading.Lock()
+
+def count_cache(name):
+    with cache_stats_lock:
+        cache_stats[name] += 1
+
+# tables whose generation could not be bumped after a write: until the
+# bump goes through their cache entries and etags are not trusted
+unbumped_tables = set()
+unbumped_lock = threading.Lock()
+
+def redis_call(func, *args):
+    # through the breaker shared with the rate limiter, raises RedisError
+    # without a round trip while it is open
+    if not redis_breaker.allow():
+        raise RedisError('redis circuit open')
+    try:
+        result = func(*args)
+    except RedisError:
+        redis_breaker.record_failure()
+        raise
+    redis_breaker.record_success()
+    return result
+
+def bump_generation(table):
+    try:
+        redis_call(redis.incr, 'cache-gen/%s' %table)
+    except RedisError:
+        count_cache('errors')
+        return False
+    with unbumped_lock:
+        unbumped_tables.discard(table)
+    return True
+
+def cache_generation(table):
+    # None when the generation cannot be read or is known to be stale
+    with unbumped_lock:
+        if table in unbumped_tables:
+            return None
+    try:
+        return (redis_call(redis.get, 'cache-gen/%s' %table) or b'0').decode()
+    except RedisError:
+        count_cache('errors')
+        return None
+
+def invalidate_cache(table):
+    if not (CACHE_ENABLED or TABLE_ETAGS):
+        return
+    if not bump_generation(table):
+        with unbumped_lock:
+            unbumped_tables.add(table)
+        app.logger.warning('could not invalidate cache of %s' %table)
+
+@app.before_request
+def retry_invalidations():
+    # a bump that failed is retried on the next request, whatever it asks
+    # for, so a write made while redis was down is not lost once it is back
+    if unbumped_tables:
+        with unbumped_lock:
+            tables = list(unbumped_tables)
+        for table in tables:
+            if not bump_generation(table):
+                break
+
+def cached(table):
+    def decorator(f):
+        def read_through(*args, **kwargs):
+            if request.method != 'GET':
+                response = make_response(f(*args, **kwargs))
+                if response.status_code < 400:
+                    invalidate_cache(table)
+                return response
+            if not CACHE_ENABLED:
+                return f(*args, **kwargs)
+            generation = cache_generation(table)
+            if generation is None:
+                return f(*args, **kwargs)
+            key = 'cache/%s/%s/%s' %(table, generation, request.full_path)
+            try:
+                data = redis_call(redis.get, key)
+            except RedisError:
+                count_cache('errors')
+                data = None
+            if data is not None:
+                count_cache('hits')
+                return Response(data, mimetype='application/json')
+            count_cache('misses')
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                try:
+                    redis_call(redis.setex, key, CACHE_TTL, response.get_data())
+                except RedisError:
+                    count_cache('errors')
+            return response
+        return update_wrapper(read_through, f)
+    return decorator
+
+
+def versioned(table):
+    # bump the table generation after a successful write, for tables that
+    # are not cached but still have generation based etags
+    def decorator(f):
+        def bump_on_write(*args, **kwargs):
+            response = make_response(f(*args, **kwargs))
+            if request.method != 'GET' and response.status_code < 400:
+                invalidate_cache(table)
+            return response
+        return update_wrapper(bump_on_write, f)
+    return decorator
+
+
+# conditional GET: the etag is worked out from a table generation or a
+# row version, so a matching If-None-Match answers 304 before the row is
+# loaded or serialized. The query string is part of the etag because
+# ?fields=, ?after= etc. change the representation.
+def make_etag(*parts):
+    parts = parts + (request.full_path,)
+    return hashlib.sha1('/'.join(str(p) for p in parts).encode('utf-8')).hexdigest()
+
+def table_etag(table):
+    # no etag, so no 304, while the generation cannot be trusted
+    def etag(*args, **kwargs):
+        if not TABLE_ETAGS:
+            return None
+        generation = cache_generation(table)
+        if generation is None:
+            return None
+        return make_etag(table, generation)
+    return etag
+
+def row_etag(model, table):
+    # the row version leads the tag so If-Match can be checked by an
+    # update without reading the row first, see etag_version
+    def etag(id, *args, **kwargs):
+        version = session.query(model.version).filter_by(id=id).scalar()
+        if version is None:
+            return None
+        return '%d-%s' %(version, make_etag(table, id, version))
+    return etag
+
+def etag_version():
+    # version in the If-Match row etag, None when there is none
+    for tag in request.if_match.as_set():
+        try:
+            return int(tag.split('-', 1)[0])
+        except ValueError:
+            abort(400)
+    return None
+
+def conditional(etag_func):
+    def decorator(f):
+        def conditional_get(*args, **kwargs):
+            if request.method != 'GET':
+                return f(*args, **kwargs)
+            tag = etag_func(*args, **kwargs)
+            if tag is None:
+                return f(*args, **kwargs)
+            if request.if_none_match.contains(tag):
+                response = Response(status=304)
+                response.set_etag(tag)
+                return response
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200 and not response.is_streamed:
+                response.set_etag(tag)
+            return response
+        return update_wrapper(conditional_get, f)
+    return decorator
+
+
+@app.route('/v1/cache/stats', methods=['GET'])
+@auth.login_required
+def viewCacheStats():
+    with cache_stats_lock:
+        stats = dict(cache_stats)
+    lookups = stats['hits'] + stats['misses']
+    stats['ratio'] = float(stats['hits']) / lookups if lookups else None
+    return jsonify(cache=stats)
+
+
+''' instrumentation '''
+# per endpoint latency, sql statements and database time, exposed at
+# /metrics and, per response, in the Server-Timing header; with
+# SQL_PROFILE slow statements and N+1 patterns are logged
+registry = metrics.Registry()
+request_latency = registry.add(metrics.Histogram(
+    'hr_request_duration_seconds', 'time spent handling a request',
+    ('endpoint', 'method', 'status')))
+request_queries = registry.add(metrics.Histogram(
+    'hr_request_sql_statements', 'sql statements issued by a request',
+    ('endpoint',), buckets=(0, 1, 2, 5, 10, 20, 50, 100, 200, 500)))
+request_db_time = registry.add(metrics.Histogram(
+    'hr_request_db_seconds', 'time spent in the database by a request',
+    ('endpoint',)))
+ratelimit_rejections = registry.add(metrics.Counter(
+    'hr_ratelimit_rejections_total', 'requests refused by the rate limiter',
+    ('endpoint',)))
+
+def collect_cache_stats():
+    with cache_stats_lock:
+        return dict(((name,), value) for name, value in cache_stats.items())
+
+registry.add(metrics.Gauge('hr_cache_lookups_total',
+                           'reference cache lookups by result', ('result',),
+                           collect_cache_stats, type='counter'))
+
+class NPlusOneError(Exception):
+    # raised for repeated statements when NPLUSONE_RAISE is set, for tests;
+    # raised from the statement itself so the request rolls back
+    pass
+
+def statement_shape(statement):
+    # same statement whatever the number of values in an IN (...)
+    return re.sub(r'\((?:\s*(?:%\(\w+\)s|%s|\?|:\w+)\s*,?)+\)', '(?)',
+                  ' '.join(statement.split()))
+
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    in_request = has_request_context() and hasattr(g, '_sql_count')
+    if in_request:
+        g._sql_count += 1
+        g._sql_time += elapsed
+    if SQL_PROFILE:
+        # only single SELECTs: an executemany or a run of batch inserts is
+        # not an N+1
+        if (in_request and not executemany and
+                statement.lstrip()[:6].upper() == 'SELECT'):
+            shape = statement_shape(statement)
+            g._sql_shapes[shape] += 1
+            if NPLUSONE_RAISE and g._sql_shapes[shape] == NPLUSONE_THRESHOLD:
+                raise NPlusOneError('%s repeated %d+ times: %s'
+                                    %(request.endpoint, NPLUSONE_THRESHOLD, shape))
+        if elapsed * 1000 >= SLOW_QUERY_MS:
+            route = request.endpoint if has_request_context() else None
+            app.logger.warning('slow query %.1fms in %s: %s'
+                               %(elapsed * 1000, route or 'background', statement))
+
+def start_request_timer():
+    g._request_start = time.perf_counter()
+    g._sql_count = 0
+    g._sql_time = 0.0
+    if SQL_PROFILE:
+        g._sql_shapes = Counter()
+
+def check_repeated_queries():
+    repeated = [(count, shape) for shape, count in g._sql_shapes.items()
+                if count >= NPLUSONE_THRESHOLD]
+    for count, shape in repeated:
+        app.logger.warning('possible N+1 in %s: %d times %s'
+                           %(request.endpoint, count, shape))
+
+def record_request(response):
+    start = getattr(g, '_request_start', None)
+    if start is None:
+        return response
+    if SQL_PROFILE:
+        check_repeated_queries()
+    elapsed = time.perf_counter() - start
+    endpoint = request.endpoint or 'none'
+    if METRICS_ENABLED:
+        request_latency.observe(elapsed, endpoint, request.method,
+                                response.status_code)
+        request_queries.observe(g._sql_count, endpoint)
+        request_db_time.observe(g._sql_time, endpoint)
+    if SERVER_TIMING:
+        response.headers.add('Server-Timing',
+                             'app;dur=%.1f, db;dur=%.1f;desc="%d queries"'
+                             %(elapsed * 1000, g._sql_time * 1000, g._sql_count))
+    return response
+
+if METRICS_ENABLED or SERVER_TIMING or SQL_PROFILE:
+    # on the Engine class, the engine itself does not exist yet
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', after_cursor_execute)
+    app.before_request(start_request_timer)
+    app.after_request(record_request)
+
+
+if METRICS_ENABLED:
+    @app.route('/metrics', methods=['GET'])
+    def viewMetrics():
+        return Response(registry.render(),
+                        mimetype='text/plain; version=0.0.4')
+
+
 # security
+auth_cache = LRUCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+def user_principal(user):
+    # what a request needs to know about the authenticated user
+    return {'id':user.id, 'email':user.email,
+            'title':user.title, 'picture':user.picture}
+
+def load_principal(user_id):
+    # user of a valid token: process cache, then redis, then the database
+    principal = auth_cache.get(user_id)
+    if principal is not None:
+        return principal
+    if AUTH_CACHE_REDIS:
+        try:
+            data = redis_call(redis.get, 'auth-user/%d' %user_id)
+        except RedisError:
+            data = None
+        if data is not None:
+            principal = json.loads(data.decode())
+            auth_cache.set(user_id, principal)
+            return principal
+    user = session.query(User).filter_by(id=user_id).first()
+    if user is None:
+        return None
+    principal = user_principal(user)
+    auth_cache.set(user_id, principal)
+    if AUTH_CACHE_REDIS:
+        try:
+            redis_call(redis.setex, 'auth-user/%d' %user_id,
+                       AUTH_CACHE_REDIS_TTL, json.dumps(principal))
+        except RedisError:
+            pass
+    return principal
+
+def invalidate_principal(user_id):
+    auth_cache.delete(user_id)
+    if AUTH_CACHE_REDIS:
+        try:
+            redis_call(redis.delete, 'auth-user/%d' %user_id)
+        except RedisError:
+            app.logger.warning('could not invalidate cached user %d' %user_id)
+
+@app.errorhandler(PasswordBusy)
+def passwordBusy(e):
+    # every password hashing process is taken and too many logins wait
+    app.logger.warning('password check refused: %s' %e)
+    return jsonify({'message':'too many logins, try again shortly'}), 503, \
+        {'Retry-After':'1'}
+
+
 @auth.verify_password
 def verify_password(username_or_token, password):
     # verify if it is token
     user_id = User.verify_auth_token(username_or_token)
     if user_id:
-        user = session.query(User).filter_by(id=user_id).one()
+        principal = load_principal(user_id)
+        if principal is None:
+            return False
+        # detached user, never added to the session
+        user = User(**principal)
     else:
         user = session.query(User).filter_by(email=username_or_token).first()
         if not user or not user.verify_password(password):
@@ -176,10 +1040,10 @@ def login():
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
 def editAccount(user_id):
-    user = session.query(User).filter_by(id=user_id).one()
     # getting account
     if request.method == 'GET':
-        return jsonify(user = user.serialize)
+        return jsonify(user = serialized_row(User, user_id))
+    user = session.query(User).filter_by(id=user_id).one()
     # editing account
     if request.method == 'PUT':
         app.logger.info('editing user')
@@ -197,12 +1061,14 @@ def editAccount(user_id):
             user.hash_password((password))
         session.add(user)
         session.commit()
+        invalidate_principal(user_id)
         return jsonify({'message':
                         'user with email %s has been updated ' %user.email})
     if request.method == 'DELETE':
         # deleting user
         session.delete(user)
         session.commit()
+        invalidate_principal(user_id)
         return jsonify({'message':'user has been deleted'})
 
 
@@ -211,9 +1077,8 @@ def editAccount(user_id):
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
 def viewAllAccounts():
-    accounts = session.query(User).all()
     if request.method == 'GET':
-        return jsonify(users = [i.serialize for i in accounts])
+        return list_response('users', User)
 
 
 ''' editing, deleting, updating and getting departments '''
@@ -222,12 +1087,14 @@ def viewAllAccounts():
 @app.route('/v1/departments/<int:id>', methods=['GET','PUT','DELETE'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('department'))
+@cached('department')
 def editDepartment(id):
     app.logger.info('editing department')
-    department = session.query(Department).filter_by(id=id).one()
     # view selected department
     if request.method == 'GET':
-        return jsonify(department=department.serialize)
+        return jsonify(department=serialized_row(Department, id))
+    department = session.query(Department).filter_by(id=id).one()
     # updating department
     if request.method == 'PUT':
         name = request.args.get('name','')
@@ -251,6 +1118,7 @@ def editDepartment(id):
 @app.route('/v1/departments/add', methods=['POST'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@cached('department')
 def createDepartment():
     app.logger.info("create department")
     if request.method == 'POST':
@@ -265,24 +1133,29 @@ def createDepartment():
 @app.route('/v1/departments/all', methods=['GET'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('department'))
+@cached('department')
 def viewAllDepartments():
-    departments = session.query(Department).all()
     if request.method == 'GET':
-        return jsonify(departments = [i.serialize for i in departments])
+        return list_response('departments', Department)
 
 
 ''' editing, deleting, updating and getting employees '''
 
 # view and modify department
-@app.route('/v1/employees/<int:id>', methods=['GET','PUT','DELETE'])
+@app.route('/v1/employees/<int:id>', methods=['GET','PUT','PATCH','DELETE'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(row_etag(Employee, 'employee'))
+@versioned('employee')
 def editEmployee(id):
     app.logger.info('editing employee')
-    emp = session.query(Employee).filter_by(id=id).one()
     # view selected employee
     if request.method == 'GET':
-        return jsonify(emp=emp.serialize)
+        return jsonify(emp=serialized_row(Employee, id))
+    if request.method == 'PATCH':
+        return patch_employee(id)
+    emp = session.query(Employee).filter_by(id=id).one()
     # updating employee
     if request.method == 'PUT':
         if request.args.get('firstName'):
@@ -332,10 +1205,54 @@ def editEmployee(id):
         return jsonify({'message':'employee has been deleted'})
 
 
+def patch_employee(id):
+    # partial update guarded by the row version: only the fields given (json
+    # body or query string) are written, in one UPDATE ... WHERE id AND
+    # version, so a concurrent edit is refused instead of overwritten. The
+    # version comes from ?version= or from the etag sent as If-Match.
+    from_json = request.mimetype == 'application/json'
+    if from_json:
+        values = request.get_json(silent=True)
+        if not isinstance(values, dict):
+            abort(400)
+        values = dict(values)
+    else:
+        values = request.args.to_dict()
+    version = values.pop('version', None)
+    if version is None:
+        version = etag_version()
+    if version is None:
+        return jsonify({'message':'version or If-Match required'}), 428
+    try:
+        version = int(version)
+    except (TypeError, ValueError):
+        abort(400)
+    values, error = clean_patch(values, EMPLOYEE_IMPORT_FIELDS, Employee,
+                                empty_is_null=not from_json)
+    if error:
+        return jsonify({'message':error}), 400
+    if not values:
+        return jsonify({'message':'nothing to update'}), 400
+    values['version'] = Employee.version + 1
+    updated = session.query(Employee).filter_by(id=id, version=version)\
+        .update(values, synchronize_session=False)
+    if not updated:
+        # only a failed update pays for this lookup
+        current = session.query(Employee.version).filter_by(id=id).scalar()
+        if current is None:
+            abort(404)
+        return jsonify({'message':'employee was changed by someone else',
+                        'version':current}), 409
+    session.commit()
+    return jsonify({'message':'employee has been updated',
+                    'emp':{'id':id, 'version':version + 1}})
+
+
 # adding a new employee
 @app.route('/v1/employees/add/department/<int:department_id>', methods=['POST'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@versioned('employee')
 def addEmployee(department_id):
     app.logger.info("create employee")
     department = session.query(Department).filter_by(id=department_id).one()
@@ -365,14 +1282,316 @@ def addEmployee(department_id):
         return jsonify({'message':'employee has been successfully created'})
 
 
+# columns accepted by the bulk import and how to read them
+EMPLOYEE_IMPORT_FIELDS = {
+    'picture':str, 'firstName':str, 'lastName':str, 'middleName':str,
+    'birthdate':'date', 'email':str, 'ssn':str, 'gender':str,
+    'homePhone':str, 'cellPhone':str, 'address':str, 'city':str,
+    'zipCode':str, 'State':str, 'hiringDate':'date', 'title':str,
+    'payRate':float, 'status':str, 'rating':int, 'department_id':int
+    }
+
+def read_import_rows():
+    # json array in the body, or a csv file with a header line
+    if request.mimetype == 'application/json':
+        rows = request.get_json(silent=True)
+        if not isinstance(rows, list):
+            abort(400)
+        return rows
+    if 'file' in request.files:
+        data = request.files['file'].read().decode('utf-8-sig')
+    else:
+        data = request.get_data(as_text=True)
+    return list(csv.DictReader(io.StringIO(data)))
+
+def clean_row(row, fields, required=()):
+    # return (mapping, error message), fields maps a name to its type
+    if not isinstance(row, dict):
+        return None, 'row is not an object'
+    mapping = {}
+    for name, value in row.items():
+        if name not in fields:
+            return None, 'unknown field %s' %name
+        if value is None or value == '':
+            continue
+        try:
+            mapping[name] = convert_value(fields[name], value)
+        except (TypeError, ValueError):
+            return None, 'invalid value for %s' %name
+    missing = [name for name in required if not mapping.get(name)]
+    if missing:
+        return None, '%s required' %' and '.join(missing)
+    return mapping, None
+
+def convert_value(kind, value):
+    if kind == 'date':
+        return datetime.datetime.strptime(str(value), '%Y-%m-%d').date()
+    return kind(value)
+
+def clean_patch(values, fields, model, empty_is_null=False):
+    # like clean_row but nothing is skipped: null clears the column, or
+    # 400 for a NOT NULL one; a query string cannot say null, so there an
+    # empty value does
+    mapping = {}
+    for name, value in values.items():
+        if name not in fields:
+            return None, 'unknown field %s' %name
+        if value is None or (empty_is_null and value == ''):
+            if not model.__table__.columns[name].nullable:
+                return None, '%s cannot be empty' %name
+            mapping[name] = None
+            continue
+        try:
+            mapping[name] = convert_value(fields[name], value)
+        except (TypeError, ValueError):
+            return None, 'invalid value for %s' %name
+    return mapping, None
+
+def clean_employee_row(row):
+    mapping, error = clean_row(row, EMPLOYEE_IMPORT_FIELDS,
+                               ('firstName', 'lastName'))
+    if error:
+        return None, error
+    mapping.setdefault('status', 'Active')
+    return mapping, None
+
+
+def import_employees(rows, batch_size, default_department=None, progress=None):
+    # check, resolve and insert rows; returns created count and row errors
+    errors = []
+    valid = []
+    for index, row in enumerate(rows):
+        mapping, error = clean_employee_row(row)
+        if error:
+            errors.append({'row':index, 'error':error})
+            continue
+        if default_department is not None:
+            mapping.setdefault('department_id', default_department)
+        valid.append((index, mapping))
+    # resolve every department with a single query
+    wanted = set(m['department_id'] for i, m in valid if 'department_id' in m)
+    known = set()
+    if wanted:
+        known = set(d for d, in session.query(Department.id)
+                    .filter(Department.id.in_(wanted)))
+    pending = []
+    for index, mapping in valid:
+        if 'department_id' in mapping and mapping['department_id'] not in known:
+            errors.append({'row':index, 'error':'unknown department %d'
+                           %mapping['department_id']})
+        else:
+            pending.append((index, mapping))
+    # every batch is a savepoint, a failing batch does not abort the others
+    created = 0
+    for start in range(0, len(pending), batch_size):
+        batch = pending[start:start + batch_size]
+        nested = session.begin_nested()
+        try:
+            session.bulk_insert_mappings(Employee, [m for i, m in batch])
+            nested.commit()
+            created += len(batch)
+        except Exception as e:
+            nested.rollback()
+            app.logger.warning('bulk employee batch failed: %s' %e)
+            errors.extend({'row':i, 'error':'database error'} for i, m in batch)
+        if progress is not None:
+            progress(start + len(batch), len(pending))
+    session.commit()
+    errors.sort(key=lambda e: e['row'])
+    return {'created':created, 'failed':len(errors), 'errors':errors}
+
+
+@job_queue.task('import_employees')
+def importEmployeesJob(progress, rows, batch_size, department_id=None):
+    result = import_employees(rows, batch_size, department_id, progress)
+    invalidate_cache('employee')
+    return result
+
+
+def job_accepted(job_id):
+    return jsonify({'job':job_id}), 202, {'Location':url_for('viewJob', id=job_id)}
+
+
+# adding many employees at once
+@app.route('/v1/employees/bulk', methods=['POST'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+@versioned('employee')
+def bulkAddEmployees():
+    # ?async=1 hands the import to a background job and answers 202
+    app.logger.info("bulk create employee")
+    rows = read_import_rows()
+    if len(rows) > BULK_MAX_ROWS:
+        return jsonify({'message':'too many rows, the limit is %d' %BULK_MAX_ROWS}), 413
+    batch_size = request.args.get('batch_size', BULK_BATCH_SIZE, type=int)
+    if batch_size is None or batch_size < 1:
+        abort(400)
+    # a department given in the url applies to rows that do not name one
+    default_department = request.args.get('department_id', type=int)
+    if request.args.get('async') in ('1', 'true'):
+        return job_accepted(job_queue.enqueue('import_employees', {
+            'rows':rows, 'batch_size':batch_size,
+            'department_id':default_department}))
+    result = import_employees(rows, batch_size, default_department)
+    return jsonify(result), 201 if result['created'] else 200
+
+
+# employees and everything that belongs to them, batch by batch
+EMPLOYEE_CHILDREN = (Education, Note, Training, Documents, Emergency, Onboarding)
+
+@job_queue.task('delete_employees')
+def deleteEmployeesJob(progress, ids, batch_size=BULK_BATCH_SIZE):
+    deleted = 0
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        for model in EMPLOYEE_CHILDREN:
+            session.query(model).filter(model.employee_id.in_(batch)) \
+                .delete(synchronize_session=False)
+        session.execute(linking_members.delete()
+                        .where(linking_members.c.employeeId.in_(batch)))
+        deleted += session.query(Employee).filter(Employee.id.in_(batch)) \
+            .delete(synchronize_session=False)
+        session.commit()
+        progress(start + len(batch), len(ids))
+    invalidate_cache('employee')
+    return {'deleted':deleted}
+
+
+@app.route('/v1/employees/bulk/delete', methods=['POST'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def bulkDeleteEmployees():
+    # json list of employee ids, deleted by a background job
+    ids = request.get_json(silent=True)
+    if isinstance(ids, dict):
+        ids = ids.get('ids')
+    if not isinstance(ids, list) or not ids:
+        abort(400)
+    try:
+        ids = [int(i) for i in ids]
+    except (TypeError, ValueError):
+        abort(400)
+    return job_accepted(job_queue.enqueue('delete_employees', {'ids':ids}))
+
+
+# employee list filters, ?name=value, all backed by employee indexes
+EMPLOYEE_FILTERS = {
+    'status':Employee.status,
+    'department_id':Employee.department_id,
+    'State':Employee.State,
+    'city':Employee.city
+    }
+EMPLOYEE_SORTS = {
+    'firstName':Employee.firstName,
+    'lastName':Employee.lastName,
+    'hiringDate':Employee.hiringDate,
+    'title':Employee.title,
+    'status':Employee.status,
+    'payRate':Employee.payRate
+    }
+
+def filtered_employees():
+    # ?hiringDateFrom= and ?hiringDateTo= are inclusive, as YYYY-MM-DD
+    query = session.query(Employee)
+    for name, column in EMPLOYEE_FILTERS.items():
+        value = request.args.get(name)
+        if value:
+            query = query.filter(column == value)
+    hired_from = parse_date_arg('hiringDateFrom')
+    if hired_from:
+        query = query.filter(Employee.hiringDate >= hired_from)
+    hired_to = parse_date_arg('hiringDateTo')
+    if hired_to:
+        query = query.filter(Employee.hiringDate <= hired_to)
+    return query
+
+
+# export formats: (mimetype, file extension)
+EXPORT_FORMATS = {
+    'csv':('text/csv', 'csv'),
+    'jsonl':('application/x-ndjson', 'jsonl'),
+    'parquet':('application/vnd.apache.parquet', 'parquet')
+    }
+
+@app.route('/v1/employees/export', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def exportEmployees():
+    # ?format=csv|jsonl|parquet, same filters and ?fields= as the list
+    format = request.args.get('format', 'csv')
+    if format not in EXPORT_FORMATS:
+        abort(400)
+    if format == 'parquet' and serializers.pyarrow is None:
+        return jsonify({'message':'parquet export needs pyarrow'}), 501
+    names, query = serializers.select_serialized(
+        filtered_employees().order_by(Employee.id), Employee,
+        requested_fields(Employee))
+    # server side cursor, rows arrive STREAM_CHUNK_SIZE at a time
+    rows = query.execution_options(stream_results=True).yield_per(STREAM_CHUNK_SIZE)
+    if format == 'csv':
+        chunks = serializers.csv_chunks(names, rows, STREAM_CHUNK_SIZE)
+    elif format == 'jsonl':
+        chunks = serializers.jsonl_chunks(names, rows, STREAM_CHUNK_SIZE)
+    else:
+        chunks = serializers.parquet_chunks(Employee, names, rows,
+                                            STREAM_CHUNK_SIZE)
+    mimetype, extension = EXPORT_FORMATS[format]
+    return Response(stream_with_context(chunks), mimetype=mimetype,
+                    headers={'Content-Disposition':
+                             'attachment; filename=employees.%s' %extension})
+
+
 # view all employee
 @app.route('/v1/employees/all', methods=['GET'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('employee'))
 def viewAllEmployees():
-    employees = session.query(Employee).all()
     if request.method == 'GET':
-        return jsonify(employees = [i.serialize for i in employees])
+        return list_response('employees', Employee, filtered_employees(),
+                             EMPLOYEE_SORTS)
+
+
+# child collections available to the profile, with their response name
+PROFILE_RELATIONS = {
+    'education':(Employee.education, 'educations'),
+    'note':(Employee.note, 'notes'),
+    'emergency':(Employee.emergency, 'emergencies'),
+    'training':(Employee.training, 'trainings'),
+    'boarding':(Employee.boarding, 'boardings'),
+    'documents':(Employee.documents, 'documents')
+    }
+PROFILE_DEFAULT = ('education', 'note', 'emergency', 'training', 'boarding')
+
+
+# employee with its child collections in one request
+@app.route('/v1/employees/<int:id>/profile', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def viewEmployeeProfile(id):
+    include = request.args.get('include')
+    if include:
+        include = [i.strip() for i in include.split(',') if i.strip()]
+        if any(i not in PROFILE_RELATIONS for i in include):
+            abort(400)
+    else:
+        include = PROFILE_DEFAULT
+    # one query for the employee and one per collection, never one per row
+    query = session.query(Employee).filter_by(id=id)
+    for name in include:
+        query = query.options(selectinload(PROFILE_RELATIONS[name][0]))
+    emp = query.first()
+    if emp is None:
+        abort(404)
+    # ?fields= picks the employee columns, the collections stay whole
+    fields = requested_fields(Employee)
+    profile = {'emp':emp.serialize}
+    if fields is not None:
+        profile['emp'] = dict((name, profile['emp'][name]) for name in fields)
+    for name in include:
+        relation, key = PROFILE_RELATIONS[name]
+        profile[key] = [i.serialize for i in getattr(emp, name)]
+    return jsonify(**profile)
 
 
 ''' editing, deleting, updating and getting education '''
@@ -383,10 +1602,10 @@ def viewAllEmployees():
 @ratelimit(limit=300, per=60*15)
 def editEmployeeEducation(id, education_id):
     app.logger.info('editing education')
-    education = session.query(Education).filter_by(id=education_id).one()
     # view selected education
     if request.method == 'GET':
-        return jsonify(education.serialize)
+        return jsonify(serialized_row(Education, education_id))
+    education = session.query(Education).filter_by(id=education_id).one()
     # updating education
     if request.method == 'PUT':
         if request.args.get('institution'):
@@ -431,9 +1650,9 @@ def createEducation(id):
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
 def viewAllEducation(id):
-    education = session.query(Education).filter_by(employee_id=id).all()
+    education = session.query(Education).filter_by(employee_id=id)
     if request.method == 'GET':
-        return jsonify(educations = [i.serialize for i in education])
+        return jsonify(educations = serialized_rows(Education, education))
 
 
 ''' editing, deleting, updating and getting note '''
@@ -443,10 +1662,10 @@ def viewAllEducation(id):
 @ratelimit(limit=300, per=60*15)
 def editEmployeeNote(id, note_id):
     app.logger.info('editing note')
-    note = session.query(Note).filter_by(id=note_id).one()
     # view selected note
     if request.method == 'GET':
-        return jsonify(note.serialize)
+        return jsonify(serialized_row(Note, note_id))
+    note = session.query(Note).filter_by(id=note_id).one()
     # updating note
     if request.method == 'PUT':
         if request.args.get('body',''):
@@ -489,9 +1708,9 @@ def createNote(id):
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
 def viewAllNote(id):
-    note = session.query(Note).filter_by(employee_id=id).all()
+    note = session.query(Note).filter_by(employee_id=id)
     if request.method == 'GET':
-        return jsonify(notes = [i.serialize for i in note])
+        return jsonify(notes = serialized_rows(Note, note))
 
 
 ''' editing, deleting, updating and getting emergency '''
@@ -501,10 +1720,10 @@ def viewAllNote(id):
 @ratelimit(limit=300, per=60*15)
 def editEmployeeEmergency(id, emergency_id):
     app.logger.info('editing emergency')
-    emergency = session.query(Emergency).filter_by(id=emergency_id).one()
     # view selected emergency
     if request.method == 'GET':
-        return jsonify(emergency.serialize)
+        return jsonify(serialized_row(Emergency, emergency_id))
+    emergency = session.query(Emergency).filter_by(id=emergency_id).one()
     # updating emergency
     if request.method == 'PUT':
         if request.args.get('firstName'):
@@ -549,9 +1768,9 @@ def createEmergency(id):
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
 def viewAllEmergency(id):
-    emergency = session.query(Emergency).filter_by(employee_id=id).all()
+    emergency = session.query(Emergency).filter_by(employee_id=id)
     if request.method == 'GET':
-        return jsonify(emergencies = [i.serialize for i in emergency])
+        return jsonify(emergencies = serialized_rows(Emergency, emergency))
 
 
 ''' editing, deleting, updating and getting training '''
@@ -561,10 +1780,10 @@ def viewAllEmergency(id):
 @ratelimit(limit=300, per=60*15)
 def editEmployeeTraining(id, training_id):
     app.logger.info('editing training')
-    training = session.query(Training).filter_by(id=training_id).one()
     # view selected training
     if request.method == 'GET':
-        return jsonify(training.serialize)
+        return jsonify(serialized_row(Training, training_id))
+    training = session.query(Training).filter_by(id=training_id).one()
     # updating training
     if request.method == 'PUT':
         if request.args.get('traininglist_id'):
@@ -613,9 +1832,9 @@ def createTraining(id):
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
 def viewAllTraining(id):
-    training = session.query(Training).filter_by(employee_id=id).all()
+    training = session.query(Training).filter_by(employee_id=id)
     if request.method == 'GET':
-        return jsonify(trainings = [i.serialize for i in training])
+        return jsonify(trainings = serialized_rows(Training, training))
 
 
 ''' editing, deleting, updating and getting onboarding '''
@@ -625,10 +1844,10 @@ def viewAllTraining(id):
 @ratelimit(limit=300, per=60*15)
 def editEmployeeBoarding(id, boarding_id):
     app.logger.info('editing boarding task')
-    boarding = session.query(Onboarding).filter_by(id=boarding_id).one()
     # view selected boarding
     if request.method == 'GET':
-        return jsonify(boarding.serialize)
+        return jsonify(serialized_row(Onboarding, boarding_id))
+    boarding = session.query(Onboarding).filter_by(id=boarding_id).one()
     # updating boarding
     if request.method == 'PUT':
         if request.args.get('onboardinglist_id'):
@@ -678,21 +1897,167 @@ def createBoarding(id):
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
 def viewAllBoarding(id):
-    boarding = session.query(Onboarding).filter_by(employee_id=id).all()
+    boarding = session.query(Onboarding).filter_by(employee_id=id)
     if request.method == 'GET':
-        return jsonify(boardings = [i.serialize for i in boarding])
+        return jsonify(boardings = serialized_rows(Onboarding, boarding))
+
+
+''' batch writes of child collections '''
+# model, accepted fields and required fields of every child collection
+CHILD_COLLECTIONS = {
+    'education':(Education, {'institution':str, 'major':str, 'start':'date',
+                             'end':'date', 'employee_id':int},
+                 ('institution',)),
+    'note':(Note, {'body':str, 'employee_id':int}, ('body',)),
+    'emergency':(Emergency, {'firstName':str, 'lastName':str, 'homePhone':str,
+                             'cellPhone':str, 'employee_id':int},
+                 ('firstName', 'lastName')),
+    'training':(Training, {'traininglist_id':int, 'provided':'date',
+                           'due':'date', 'employee_id':int}, ()),
+    'boarding':(Onboarding, {'onboardinglist_id':int, 'provided':'date',
+                             'expired':'date', 'employee_id':int},
+                ('provided',))
+    }
+
+def insert_rows(model, mappings, return_ids):
+    # executemany in BULK_BATCH_SIZE batches, one per set of keys since
+    # clean_row leaves empty fields out; fetching the new ids (opt-in)
+    # means one insert per row, still without any per-row lookup or commit
+    ids = []
+    for start in range(0, len(mappings), BULK_BATCH_SIZE):
+        batch = mappings[start:start + BULK_BATCH_SIZE]
+        session.bulk_insert_mappings(model, batch, return_defaults=return_ids)
+        if return_ids:
+            ids.extend(m['id'] for m in batch)
+    return ids
+
+
+@app.route('/v1/employees/batch/<collection>', methods=['POST'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def batchCreateChildren(collection):
+    # json array of records, each with its employee_id unless ?employee_id=
+    # gives one for all; all rows are inserted in one transaction or none.
+    # ?return_ids=1 also returns the new ids, at the cost of one insert
+    # per row instead of one per batch
+    if collection not in CHILD_COLLECTIONS:
+        abort(404)
+    model, fields, required = CHILD_COLLECTIONS[collection]
+    rows = request.get_json(silent=True)
+    if not isinstance(rows, list) or not rows:
+        abort(400)
+    if len(rows) > BULK_MAX_ROWS:
+        return jsonify({'message':'too many rows, the limit is %d' %BULK_MAX_ROWS}), 413
+    default_employee = request.args.get('employee_id', type=int)
+    errors = []
+    mappings = []
+    for index, row in enumerate(rows):
+        mapping, error = clean_row(row, fields, required)
+        if not error:
+            if default_employee is not None:
+                mapping.setdefault('employee_id', default_employee)
+            if 'employee_id' not in mapping:
+                error = 'employee_id required'
+        if error:
+            errors.append({'row':index, 'error':error})
+            continue
+        if model is Note:
+            mapping['user_id'] = g.user.id
+        mappings.append((index, mapping))
+    # every employee checked with one query
+    wanted = set(m['employee_id'] for i, m in mappings)
+    known = set(e for e, in session.query(Employee.id)
+                .filter(Employee.id.in_(wanted))) if wanted else set()
+    for index, mapping in mappings:
+        if mapping['employee_id'] not in known:
+            errors.append({'row':index, 'error':'unknown employee %d'
+                           %mapping['employee_id']})
+    if errors:
+        errors.sort(key=lambda e: e['row'])
+        return jsonify({'created':0, 'errors':errors}), 400
+    mappings = [m for i, m in mappings]
+    return_ids = request.args.get('return_ids') in ('1', 'true')
+    ids = insert_rows(model, mappings, return_ids)
+    session.commit()
+    result = {'created':len(mappings)}
+    if return_ids:
+        result['ids'] = ids
+    return jsonify(result), 201
+
+
+def assign_to_employees(model, list_column, list_id, values):
+    # one INSERT ... SELECT for every employee matched by the request:
+    # ?department_id=, ?status= and/or a json {"employee_ids": [...]};
+    # ?skip_existing=1 leaves out employees who already have the item.
+    # Returns the new ids, read back in the same transaction as the rows
+    # of this list above the highest id before the insert
+    query = select([literal(list_id)] + [literal(v) for k, v in values] +
+                   [Employee.id])
+    department_id = request.args.get('department_id', type=int)
+    if department_id is not None:
+        query = query.where(Employee.department_id == department_id)
+    if request.args.get('status'):
+        query = query.where(Employee.status == request.args.get('status'))
+    body = request.get_json(silent=True) or {}
+    employee_ids = body.get('employee_ids') if isinstance(body, dict) else None
+    if employee_ids is not None:
+        try:
+            query = query.where(Employee.id.in_([int(i) for i in employee_ids]))
+        except (TypeError, ValueError):
+            abort(400)
+    if department_id is None and employee_ids is None:
+        abort(400)
+    if request.args.get('skip_existing') in ('1', 'true'):
+        query = query.where(~exists().where(and_(
+            model.employee_id == Employee.id, list_column == list_id)))
+    columns = [list_column.key] + [k for k, v in values] + ['employee_id']
+    last_id = session.query(func.max(model.id)).scalar() or 0
+    session.execute(model.__table__.insert().from_select(columns, query))
+    ids = [i for i, in session.query(model.id)
+           .filter(model.id > last_id, list_column == list_id)
+           .order_by(model.id)]
+    session.commit()
+    return ids
+
+
+@app.route('/v1/company/list_of_training/<int:id>/assign', methods=['POST'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def assignTraining(id):
+    # ?due=YYYY-MM-DD, ?provided= defaults to today
+    session.query(Traininglist).filter_by(id=id).one()
+    provided = parse_date_arg('provided') or datetime.date.today()
+    ids = assign_to_employees(Training, Training.traininglist_id, id,
+                              [('provided', provided),
+                               ('due', parse_date_arg('due'))])
+    return jsonify({'created':len(ids), 'ids':ids}), 201
+
+
+@app.route('/v1/company/list_of_boarding/<int:id>/assign', methods=['POST'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def assignBoarding(id):
+    # ?expired=YYYY-MM-DD, ?provided= defaults to today
+    session.query(Onboardinglist).filter_by(id=id).one()
+    provided = parse_date_arg('provided') or datetime.date.today()
+    ids = assign_to_employees(Onboarding, Onboarding.onboardinglist_id, id,
+                              [('provided', provided),
+                               ('expired', parse_date_arg('expired'))])
+    return jsonify({'created':len(ids), 'ids':ids}), 201
 
 
 ''' About the company'''
 @app.route('/v1/company/<int:id>', methods=['GET','PUT','DELETE'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('company'))
+@cached('company')
 def editCompany(id):
     app.logger.info('editing boarding task')
-    compnay = session.query(Company).filter_by(id=id).first()
     # view selected company
     if request.method == 'GET':
-        return jsonify(compnay.serialize)
+        return jsonify(serialized_row(Company, id))
+    compnay = session.query(Company).filter_by(id=id).first()
     # updating company
     if request.method == 'PUT':
         if request.args.get('name'):
@@ -712,6 +2077,7 @@ def editCompany(id):
 @app.route('/v1/company/add', methods=['POST'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@cached('company')
 def createCompany():
     app.logger.info("create company")
     if request.method == 'POST':
@@ -726,22 +2092,25 @@ def createCompany():
 @app.route('/v1/company/all', methods=['GET'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('company'))
+@cached('company')
 def viewCompany():
-    company = session.query(Company).all()
     if request.method == 'GET':
-        return jsonify(company = [i.serialize for i in company])
+        return list_response('company', Company)
 
 
 ''' About the company links'''
 @app.route('/v1/company/links/<int:id>', methods=['GET','PUT','DELETE'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('companylinks'))
+@cached('companylinks')
 def editCompanyLinks(id):
     app.logger.info('editing boarding task')
-    links = session.query(CompanyLinks).filter_by(id=id).one()
     # view selected department
     if request.method == 'GET':
-        return jsonify(links.serialize)
+        return jsonify(serialized_row(CompanyLinks, id))
+    links = session.query(CompanyLinks).filter_by(id=id).one()
     # updating department
     if request.method == 'PUT':
         if request.args.get('name'):
@@ -763,6 +2132,7 @@ def editCompanyLinks(id):
 @app.route('/v1/company/links/add', methods=['POST'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@cached('companylinks')
 def createCompanyLinks():
     app.logger.info("create company")
     if request.method == 'POST':
@@ -778,10 +2148,11 @@ def createCompanyLinks():
 @app.route('/v1/company/links/all', methods=['GET'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('companylinks'))
+@cached('companylinks')
 def viewCompanyLinks():
-    companyLinks = session.query(CompanyLinks).all()
     if request.method == 'GET':
-        return jsonify(companyLinks = [i.serialize for i in companyLinks])
+        return list_response('companyLinks', CompanyLinks)
 
 
 ''' list of Training and onboarding task '''
@@ -789,12 +2160,14 @@ def viewCompanyLinks():
 @app.route('/v1/company/list_of_training/<int:id>', methods=['GET','PUT','DELETE'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('traininglist'))
+@cached('traininglist')
 def editTrainingList(id):
     app.logger.info('editing training list')
-    training = session.query(Traininglist).filter_by(id=id).one()
     # view selected department
     if request.method == 'GET':
-        return jsonify(training.serialize)
+        return jsonify(serialized_row(Traininglist, id))
+    training = session.query(Traininglist).filter_by(id=id).one()
     # updating department
     if request.method == 'PUT':
         if request.args.get('name'):
@@ -816,6 +2189,7 @@ def editTrainingList(id):
 @app.route('/v1/company/list_of_training/add', methods=['POST'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@cached('traininglist')
 def createTrainingItem():
     app.logger.info("create training item")
     if request.method == 'POST':
@@ -831,21 +2205,24 @@ def createTrainingItem():
 @app.route('/v1/company/list_of_training/all', methods=['GET'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('traininglist'))
+@cached('traininglist')
 def viewTrainingList():
-    traininglist = session.query(Traininglist).all()
     if request.method == 'GET':
-        return jsonify(traininglist = [i.serialize for i in traininglist])
+        return list_response('traininglist', Traininglist)
 
 
 @app.route('/v1/company/list_of_boarding/<int:id>', methods=['GET','PUT','DELETE'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('onboardinglist'))
+@cached('onboardinglist')
 def editBoardingList(id):
     app.logger.info('editing boarding list')
-    boarding = session.query(Onboardinglist).filter_by(id=id).one()
     # view selected department
     if request.method == 'GET':
-        return jsonify(boarding.serialize)
+        return jsonify(serialized_row(Onboardinglist, id))
+    boarding = session.query(Onboardinglist).filter_by(id=id).one()
     # updating department
     if request.method == 'PUT':
         if request.args.get('name'):
@@ -867,6 +2244,7 @@ def editBoardingList(id):
 @app.route('/v1/company/list_of_boarding/add', methods=['POST'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@cached('onboardinglist')
 def createBoardingItem():
     app.logger.info("create training item")
     if request.method == 'POST':
@@ -882,19 +2260,391 @@ def createBoardingItem():
 @app.route('/v1/company/list_of_boarding/all', methods=['GET'])
 @auth.login_required
 @ratelimit(limit=300, per=60*15)
+@conditional(table_etag('onboardinglist'))
+@cached('onboardinglist')
 def viewBoardingList():
-    onboardinglist = session.query(Onboardinglist).all()
     if request.method == 'GET':
-        return jsonify(onboardinglist = [i.serialize for i in onboardinglist])
+        return list_response('onboardinglist', Onboardinglist)
+
+
+''' Reports '''
+# aggregates computed by the database with GROUP BY; the result of each
+# report is kept as a snapshot so dashboards do not rescan the tables.
+# ?fresh=1 recomputes and replaces the snapshot.
+def headcount_report():
+    rows = (session.query(Employee.department_id, Department.name,
+                          Employee.status, func.count(Employee.id))
+            .outerjoin(Department, Employee.department_id == Department.id)
+            .group_by(Employee.department_id, Department.name, Employee.status)
+            .order_by(Employee.department_id, Employee.status))
+    return [{'departmentId':d, 'department':n, 'status':st, 'count':c}
+            for d, n, st, c in rows]
+
+def status_report():
+    # turnover: employees per status, overall and by year of hire
+    rows = (session.query(Employee.status, func.count(Employee.id))
+            .group_by(Employee.status).order_by(Employee.status))
+    totals = [{'status':st, 'count':c} for st, c in rows]
+    year = func.extract('year', Employee.hiringDate)
+    rows = (session.query(year, Employee.status, func.count(Employee.id))
+            .group_by(year, Employee.status).order_by(year, Employee.status))
+    by_year = [{'hiringYear':int(y) if y is not None else None,
+                'status':st, 'count':c} for y, st, c in rows]
+    return {'total':totals, 'byHiringYear':by_year}
+
+def payrate_report(by):
+    column = Employee.title if by == 'title' else Employee.department_id
+    rows = (session.query(column, func.count(Employee.id),
+                          func.avg(Employee.payRate), func.min(Employee.payRate),
+                          func.max(Employee.payRate))
+            .filter(Employee.payRate.isnot(None))
+            .group_by(column).order_by(column))
+    key = 'title' if by == 'title' else 'departmentId'
+    return [{key:k, 'count':c, 'average':float(a) if a is not None else None,
+             'min':lo, 'max':hi} for k, c, a, lo, hi in rows]
+
+def training_report():
+    # per training: assigned, provided (on or before today), overdue (due
+    # date passed) and current (provided and not overdue). provided is
+    # filled in when a training is assigned, so compliance is the share of
+    # assignments that are current rather than the share provided
+    today = datetime.date.today()
+    provided = Training.provided <= today
+    overdue = Training.due < today
+    rows = (session.query(Traininglist.id, Traininglist.name,
+                          func.count(Training.id),
+                          func.sum(case([(provided, 1)], else_=0)),
+                          func.sum(case([(overdue, 1)], else_=0)),
+                          func.sum(case([(and_(provided, or_(Training.due.is_(None),
+                                                             Training.due >= today)),
+                                          1)], else_=0)))
+            .outerjoin(Training, Training.traininglist_id == Traininglist.id)
+            .group_by(Traininglist.id, Traininglist.name)
+            .order_by(Traininglist.id))
+    return [{'trainingListID':i, 'name':n, 'assigned':a, 'provided':int(p or 0),
+             'overdue':int(o or 0), 'current':int(c or 0),
+             'compliance':float(c or 0) / a if a else None}
+            for i, n, a, p, o, c in rows]
+
+def store_report(name, compute, params):
+    report = {'report':name, 'params':params,
+              'generatedAt':datetime.datetime.utcnow().isoformat(),
+              'data':compute()}
+    data = flask_dumps(report)
+    if REPORT_SNAPSHOTS:
+        try:
+            redis_call(redis.setex, report_key(name, params),
+                       REPORT_SNAPSHOT_TTL, data)
+        except RedisError:
+            app.logger.warning('could not store report snapshot %s' %name)
+    return data
+
+def report_key(name, params):
+    return 'report/%s/%s' %(name, '&'.join('%s=%s' %i for i in sorted(params.items())))
+
+def report_snapshot(name, compute, params=None):
+    params = params or {}
+    fresh = request.args.get('fresh') in ('1', 'true')
+    if REPORT_SNAPSHOTS and not fresh:
+        try:
+            data = redis_call(redis.get, report_key(name, params))
+        except RedisError:
+            data = None
+        if data is not None:
+            return Response(data, mimetype='application/json')
+    return Response(store_report(name, compute, params),
+                    mimetype='application/json')
+
+
+# every report with the parameters the dashboards use
+REPORTS = (
+    ('headcount', headcount_report, {}),
+    ('status', status_report, {}),
+    ('payrate', lambda: payrate_report('department'), {'by':'department'}),
+    ('payrate', lambda: payrate_report('title'), {'by':'title'}),
+    ('training', training_report, {})
+    )
+
+@job_queue.task('refresh_reports')
+def refreshReportsJob(progress):
+    for index, (name, compute, params) in enumerate(REPORTS):
+        store_report(name, compute, params)
+        progress(index + 1, len(REPORTS))
+    return {'reports':len(REPORTS)}
+
+
+@app.route('/v1/reports/refresh', methods=['POST'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def refreshReports():
+    return job_accepted(job_queue.enqueue('refresh_reports'))
+
+
+@app.cli.command('refresh-reports')
+def refreshReportsCommand():
+    # run more often than REPORT_SNAPSHOT_TTL so dashboards never pay for
+    # the scans, e.g. from cron: flask refresh-reports
+    with app.test_request_context():
+        try:
+            result = refreshReportsJob(lambda done, total=None: None)
+        finally:
+            session.remove()
+    print('%d report snapshots stored' %result['reports'])
+
+
+@app.route('/v1/reports/headcount', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def headcountReport():
+    return report_snapshot('headcount', headcount_report)
+
+
+@app.route('/v1/reports/status', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def statusReport():
+    return report_snapshot('status', status_report)
+
+
+@app.route('/v1/reports/payrate', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def payrateReport():
+    # ?by=department (default) or ?by=title
+    by = request.args.get('by', 'department')
+    if by not in ('department', 'title'):
+        abort(400)
+    return report_snapshot('payrate', lambda: payrate_report(by), {'by':by})
+
+
+@app.route('/v1/reports/training', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def trainingReport():
+    return report_snapshot('training', training_report)
+
+
+''' Compliance '''
+# training due dates and onboarding expiry dates, read through their
+# indexes in one query per kind instead of one request per employee
+def parse_within(value):
+    # '30d', '4w' or a number of days, None past COMPLIANCE_MAX_WITHIN
+    match = re.match(r'^(\d+)([dw]?)$', value or '')
+    if not match:
+        return None
+    days = int(match.group(1))
+    days = days * 7 if match.group(2) == 'w' else days
+    return days if days <= COMPLIANCE_MAX_WITHIN else None
+
+def expiring_trainings(until, since=None):
+    query = (session.query(Training.id, Training.due, Training.employee_id,
+                           Employee.firstName, Employee.lastName,
+                           Employee.department_id, Traininglist.id,
+                           Traininglist.name)
+             .join(Employee, Training.employee_id == Employee.id)
+             .outerjoin(Traininglist, Training.traininglist_id == Traininglist.id)
+             .filter(Training.due <= until))
+    if since is not None:
+        query = query.filter(Training.due >= since)
+    return [{'id':i, 'due':due, 'employeeId':e, 'firstName':fn, 'lastName':ln,
+             'departmentId':d, 'trainingListID':tl, 'name':n}
+            for i, due, e, fn, ln, d, tl, n in query.order_by(Training.due)]
+
+def expiring_boardings(until, since=None):
+    query = (session.query(Onboarding.id, Onboarding.expired,
+                           Onboarding.employee_id, Employee.firstName,
+                           Employee.lastName, Employee.department_id,
+                           Onboardinglist.id, Onboardinglist.name)
+             .join(Employee, Onboarding.employee_id == Employee.id)
+             .outerjoin(Onboardinglist,
+                        Onboarding.onboardinglist_id == Onboardinglist.id)
+             .filter(Onboarding.expired <= until))
+    if since is not None:
+        query = query.filter(Onboarding.expired >= since)
+    return [{'id':i, 'expired':exp, 'employeeId':e, 'firstName':fn,
+             'lastName':ln, 'departmentId':d, 'onboardingListId':ol, 'name':n}
+            for i, exp, e, fn, ln, d, ol, n in query.order_by(Onboarding.expired)]
+
+def build_expiry_digest(day=None):
+    # everything overdue or expiring within COMPLIANCE_DIGEST_DAYS of day
+    day = day or datetime.date.today()
+    until = day + datetime.timedelta(days=COMPLIANCE_DIGEST_DAYS)
+    trainings = expiring_trainings(until)
+    boardings = expiring_boardings(until)
+    digest = {'date':day.isoformat(), 'within':COMPLIANCE_DIGEST_DAYS,
+              'generatedAt':datetime.datetime.utcnow().isoformat(),
+              'trainings':trainings, 'boardings':boardings,
+              'counts':{'trainings':len(trainings), 'boardings':len(boardings)}}
+    data = flask_dumps(digest)
+    try:
+        redis_call(redis.setex, 'compliance-digest/%s' %day.isoformat(),
+                   COMPLIANCE_DIGEST_TTL, data)
+    except RedisError:
+        app.logger.warning('could not store compliance digest')
+    return data
+
+
+@job_queue.task('expiry_digest')
+def expiryDigestJob(progress):
+    return {'bytes':len(build_expiry_digest())}
+
+
+@app.cli.command('expiry-digest')
+def expiryDigestCommand():
+    # run daily, e.g. from cron: flask expiry-digest
+    with app.test_request_context():
+        try:
+            data = build_expiry_digest()
+        finally:
+            session.remove()
+    print('compliance digest stored, %d bytes' %len(data))
+
+
+@app.route('/v1/compliance/digest/refresh', methods=['POST'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def refreshExpiryDigest():
+    return job_accepted(job_queue.enqueue('expiry_digest'))
+
+
+@app.route('/v1/compliance/expiring', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def viewExpiring():
+    # ?within=30d, ?overdue=1 also lists what is already past due
+    within = parse_within(request.args.get('within', '30d'))
+    if within is None:
+        abort(400)
+    today = datetime.date.today()
+    until = today + datetime.timedelta(days=within)
+    since = None if request.args.get('overdue') in ('1', 'true') else today
+    return jsonify(within=within,
+                   trainings=expiring_trainings(until, since),
+                   boardings=expiring_boardings(until, since))
+
+
+@app.route('/v1/compliance/digest', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def viewExpiryDigest():
+    # today's precomputed digest, built on the spot if the job has not run
+    try:
+        data = redis_call(redis.get, 'compliance-digest/%s'
+                          %datetime.date.today().isoformat())
+    except RedisError:
+        data = None
+    if data is None:
+        data = build_expiry_digest()
+    return Response(data, mimetype='application/json')
+
+
+''' Background jobs '''
+@app.route('/v1/jobs/<id>', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def viewJob(id):
+    try:
+        job = job_queue.get(id)
+    except RedisError:
+        abort(503)
+    if job is None:
+        abort(404)
+    job = dict(job)
+    job.pop('payload', None)
+    return jsonify(job=job)
+
+
+@app.cli.command('worker')
+@click.option('--burst', is_flag=True, help='stop once the queue is empty')
+def workerCommand(burst):
+    # runs queued jobs: flask worker
+    job_queue.work(connection=Redis(), burst=burst)
+
+
+''' Search '''
+# ranked lookups by name; on mysql they use the FULLTEXT indexes declared
+# in models.py, elsewhere (or for very short words) a prefix match on the
+# (lastName, firstName) indexes
+SEARCH_TARGETS = {
+    'employee':('employees', 'employee', 'firstName, lastName, email',
+                'id, firstName, lastName, title, department_id AS departmentId'),
+    'patient':('patients', 'patient', 'firstName, lastName, patientId',
+               'id, patientId, firstName, lastName, status')
+    }
+SEARCH_PREFIX_COLUMNS = {
+    'employee':(Employee, (Employee.id, Employee.firstName, Employee.lastName,
+                           Employee.title, Employee.department_id.label('departmentId'))),
+    'patient':(Patient, (Patient.id, Patient.patientId, Patient.firstName,
+                         Patient.lastName, Patient.status))
+    }
+
+def fulltext_search(target, words, limit):
+    key, table, indexed, columns = SEARCH_TARGETS[target]
+    match = 'MATCH (%s) AGAINST (:q IN BOOLEAN MODE)' %indexed
+    rows = session.execute(text(
+        'SELECT %s, %s AS score FROM %s WHERE %s ORDER BY score DESC LIMIT :limit'
+        %(columns, match, table, match)),
+        {'q':' '.join('+%s*' %w for w in words), 'limit':limit})
+    return [dict(zip(row.keys(), row)) for row in rows]
+
+def prefix_search(target, words, limit):
+    model, columns = SEARCH_PREFIX_COLUMNS[target]
+    query = session.query(*columns)
+    for word in words:
+        query = query.filter(or_(model.lastName.like(word + '%'),
+                                 model.firstName.like(word + '%')))
+    # exact last name matches first
+    rows = query.order_by((model.lastName == words[0]).desc(),
+                          model.lastName, model.firstName).limit(limit)
+    return [dict(zip([c.key for c in columns], row), score=None)
+            for row in rows]
+
+
+@app.route('/v1/search', methods=['GET'])
+@auth.login_required
+@ratelimit(limit=300, per=60*15)
+def search():
+    # ?q=<words>&type=employee,patient&limit=<n>
+    words = re.findall(r'\w+', request.args.get('q', ''), re.UNICODE)
+    if not words:
+        abort(400)
+    types = request.args.get('type', 'employee,patient').split(',')
+    if any(t not in SEARCH_TARGETS for t in types):
+        abort(400)
+    limit = request.args.get('limit', SEARCH_LIMIT, type=int)
+    if limit is None or limit < 1:
+        abort(400)
+    limit = min(limit, SEARCH_MAX_LIMIT)
+    fulltext = (session.get_bind().dialect.name == 'mysql' and
+                all(len(w) >= SEARCH_MIN_TOKEN for w in words))
+    results = {}
+    for target in types:
+        if fulltext:
+            results[SEARCH_TARGETS[target][0]] = fulltext_search(target, words, limit)
+        else:
+            results[SEARCH_TARGETS[target][0]] = prefix_search(target, words, limit)
+    return jsonify(**results)
 
 
 ''' Patient Side '''
 
 
 
+@app.cli.command('init-db')
+def initDbCommand():
+    # create the tables and add missing columns and indexes: flask init-db
+    init_db()
+    print('database is up to date')
+
+
+def create_app(database_url=None, **engine_options):
+    # application factory for wsgi servers, e.g. gunicorn 'app:create_app()';
+    # nothing connects to the database until the first request
+    if database_url or engine_options:
+        configure_engine(database_url, **engine_options)
+    return app
+
+
 if __name__ == '__main__':
     app.debug = True
-    app.config['SECRET_KEY'] = ''.join(random.choice(string.ascii_uppercase +
-                                                     string.digits)
-                                       for x in range(32))
     app.run(host='0.0.0.0', port=5000)
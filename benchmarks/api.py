@@ -0,0 +1,227 @@
+# !/usr/bin/env python3
+# load benchmark of the api: seeds synthetic data with the models.py schema
+# and drives the flask routes through the test client, reporting p50/p99
+# latency and throughput for list, detail, write and auth paths.
+#
+#   python benchmarks/api.py                       # sqlite file in a tmp dir
+#   python benchmarks/api.py --database-url mysql+pymysql://u:p@localhost/bench
+#   python benchmarks/api.py --output run.json --compare previous.json
+#
+# redis is not needed and never called: the memory rate limiter is used,
+# the reference cache, table etags (and so the generation bumps on writes),
+# the redis user cache and report snapshots are off. Each request comes
+# from its own address so the rate limiter never refuses it.
+import os, sys, time, json, random, types, base64, tempfile, datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+PASSWORD = 'benchmark'
+EMAIL = 'bench@example.com'
+
+
+def install_config(database_url):
+    # the app reads its settings from a config module
+    config = types.ModuleType('config')
+    config.DB_USER = config.DB_PASSWORD = config.DB_END = ''
+    config.DB_PORT = config.DB_DATABASE = ''
+    config.DATABASE_URL = database_url
+    config.RATELIMIT_ENGINE = 'memory'
+    config.CACHE_ENABLED = False
+    config.TABLE_ETAGS = False
+    config.AUTH_CACHE_REDIS = False
+    config.REPORT_SNAPSHOTS = False
+    sys.modules['config'] = config
+
+
+def seed(session, models, args):
+    today = datetime.date.today()
+    user = models.User(email=EMAIL, title='admin')
+    user.hash_password(PASSWORD)
+    session.add(user)
+    session.flush()
+    session.bulk_insert_mappings(models.Department, [
+        {'id':i + 1, 'name':'Department %d' %i} for i in range(args.departments)])
+    session.bulk_insert_mappings(models.Traininglist, [
+        {'id':i + 1, 'name':'Training %d' %i} for i in range(10)])
+    employees = []
+    for i in range(args.employees):
+        employees.append({
+            'id':i + 1, 'firstName':random.choice(FIRST_NAMES),
+            'lastName':'%s%d' %(random.choice(LAST_NAMES), i),
+            'email':'employee%d@example.com' %i, 'ssn':'%09d' %i,
+            'gender':random.choice(['F', 'M']), 'city':'Boston',
+            'State':random.choice(['MA', 'NH', 'RI']), 'zipCode':'02110',
+            'title':random.choice(['Nurse', 'Doctor', 'Clerk']),
+            'birthdate':today - datetime.timedelta(days=8000 + i % 9000),
+            'hiringDate':today - datetime.timedelta(days=i % 4000),
+            'payRate':25.0 + i % 40, 'status':random.choice(['Active'] * 9 + ['Inactive']),
+            'rating':i % 5, 'department_id':i % args.departments + 1})
+        if len(employees) >= 5000:
+            session.bulk_insert_mappings(models.Employee, employees)
+            employees = []
+    session.bulk_insert_mappings(models.Employee, employees)
+    for model, per_employee, row in (
+            (models.Education, args.education,
+             lambda e: {'institution':'University', 'major':'Nursing',
+                        'employee_id':e}),
+            (models.Training, args.training,
+             lambda e: {'traininglist_id':random.randint(1, 10),
+                        'provided':today,
+                        'due':today + datetime.timedelta(days=random.randint(-30, 365)),
+                        'employee_id':e}),
+            (models.Note, args.notes,
+             lambda e: {'body':'note', 'user_id':user.id, 'employee_id':e})):
+        rows = [row(e + 1) for e in range(args.employees) for n in range(per_employee)]
+        for start in range(0, len(rows), 5000):
+            session.bulk_insert_mappings(model, rows[start:start + 5000])
+    session.bulk_insert_mappings(models.Patient, [
+        {'patientId':'P%d' %i, 'firstName':random.choice(FIRST_NAMES),
+         'lastName':random.choice(LAST_NAMES), 'status':'Admitted'}
+        for i in range(args.patients)])
+    session.commit()
+
+
+FIRST_NAMES = ['Ann', 'Bob', 'Carla', 'Dan', 'Eve', 'Frank', 'Gina', 'Hugo']
+LAST_NAMES = ['Smith', 'Jones', 'Brown', 'Garcia', 'Miller', 'Davis']
+
+
+def basic_auth(username, password):
+    token = base64.b64encode(('%s:%s' %(username, password)).encode()).decode()
+    return {'Authorization':'Basic ' + token}
+
+
+def scenarios(args, token):
+    # name -> (number of requests, function returning (method, url, headers))
+    employee = lambda: random.randint(1, args.employees)
+    auth = basic_auth(token, '')
+    return [
+        ('auth password', args.auth_requests,
+         lambda: ('GET', '/token', basic_auth(EMAIL, PASSWORD))),
+        ('auth token', args.requests,
+         lambda: ('GET', '/v1/company/all', auth)),
+        ('list employees', args.requests,
+         lambda: ('GET', '/v1/employees/all?limit=100&after=%d'
+                  %random.randint(0, max(args.employees - 100, 0)), auth)),
+        ('list employees fast', args.requests,
+         lambda: ('GET', '/v1/employees/all?limit=100&fast=1&after=%d'
+                  %random.randint(0, max(args.employees - 100, 0)), auth)),
+        ('list filtered sorted', args.requests,
+         lambda: ('GET', '/v1/employees/all?status=Active&department_id=%d'
+                  '&sort=lastName&limit=50' %random.randint(1, args.departments),
+                  auth)),
+        ('employee detail', args.requests,
+         lambda: ('GET', '/v1/employees/%d' %employee(), auth)),
+        ('employee profile', args.requests,
+         lambda: ('GET', '/v1/employees/%d/profile' %employee(), auth)),
+        ('search', args.requests,
+         lambda: ('GET', '/v1/search?q=%s' %random.choice(LAST_NAMES), auth)),
+        ('update employee', args.requests,
+         lambda: ('PUT', '/v1/employees/%d?title=Nurse' %employee(), auth)),
+        ('add note', args.requests,
+         lambda: ('POST', '/v1/employees/%d/note/add?body=bench' %employee(), auth)),
+        ]
+
+
+def percentile(values, fraction):
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def run_scenario(app, count, make_request, threads):
+    def worker(n):
+        client = app.test_client()
+        timings = []
+        errors = 0
+        for i in range(n):
+            method, url, headers = make_request()
+            address = '10.%d.%d.%d' %(random.randint(0, 255),
+                                      random.randint(0, 255), random.randint(1, 254))
+            start = time.perf_counter()
+            response = client.open(url, method=method, headers=headers,
+                                   environ_base={'REMOTE_ADDR':address})
+            timings.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+        return timings, errors
+
+    shares = [count // threads + (1 if i < count % threads else 0)
+              for i in range(threads)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        results = list(pool.map(worker, shares))
+    elapsed = time.perf_counter() - start
+    timings = sorted(t for result in results for t in result[0])
+    return {'requests':len(timings), 'errors':sum(r[1] for r in results),
+            'p50_ms':percentile(timings, 0.5) * 1000,
+            'p99_ms':percentile(timings, 0.99) * 1000,
+            'rps':len(timings) / elapsed if elapsed else 0}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='latency and throughput of the api routes')
+    parser.add_argument('--database-url', help='defaults to a temporary sqlite file')
+    parser.add_argument('--departments', type=int, default=20)
+    parser.add_argument('--employees', type=int, default=10000)
+    parser.add_argument('--education', type=int, default=1, help='rows per employee')
+    parser.add_argument('--training', type=int, default=3, help='rows per employee')
+    parser.add_argument('--notes', type=int, default=2, help='rows per employee')
+    parser.add_argument('--patients', type=int, default=5000)
+    parser.add_argument('--requests', type=int, default=500, help='per scenario')
+    parser.add_argument('--auth-requests', type=int, default=20,
+                        help='password logins, each one hashes')
+    parser.add_argument('--threads', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='write the results as json')
+    parser.add_argument('--compare', help='json results of an earlier run')
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    database_url = args.database_url or 'sqlite:///%s' %os.path.join(
+        tempfile.mkdtemp(prefix='hr-bench-'), 'bench.db')
+    install_config(database_url)
+    import models
+    from app import app, session
+
+    start = time.perf_counter()
+    models.init_db()
+    seed(session, models, args)
+    session.remove()
+    print('seeded %d employees on %s in %.1fs' %(
+        args.employees, database_url.split('@')[-1], time.perf_counter() - start))
+
+    client = app.test_client()
+    token = json.loads(client.get('/token', headers=basic_auth(EMAIL, PASSWORD))
+                       .get_data(as_text=True))['token']
+
+    previous = {}
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)['results']
+    results = {}
+    print('%-22s %8s %7s %9s %9s %9s' %('scenario', 'requests', 'errors',
+                                        'p50 ms', 'p99 ms', 'req/s'))
+    for name, count, make_request in scenarios(args, token):
+        if count <= 0:
+            continue
+        result = results[name] = run_scenario(app, count, make_request,
+                                              args.threads)
+        line = '%-22s %8d %7d %9.2f %9.2f %9.1f' %(
+            name, result['requests'], result['errors'], result['p50_ms'],
+            result['p99_ms'], result['rps'])
+        if name in previous and previous[name]['rps']:
+            line += '  %+.1f%% req/s' %(
+                (result['rps'] / previous[name]['rps'] - 1) * 100)
+        print(line)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'args':vars(args), 'database':database_url.split('@')[-1],
+                       'results':results}, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
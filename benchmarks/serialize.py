@@ -0,0 +1,82 @@
+# !/usr/bin/env python3
+# compare the ORM + serialize + jsonify path with the tuple + orjson path
+# used by the list endpoints, on an in-memory sqlite database
+#
+#   python benchmarks/serialize.py [number of employees]
+import os, sys, time, datetime, random, types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# standalone: a config module of its own, so nothing reads config.py or
+# reaches for the mysql database it names
+config = types.ModuleType('config')
+config.DATABASE_URL = 'sqlite://'
+sys.modules['config'] = config
+
+from flask import Flask
+from flask import json as flask_json
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from models import Base, Department, Employee
+import serializers
+
+
+def seed(session, count):
+    session.add(Department(id=1, name='Nursing'))
+    today = datetime.date.today()
+    rows = [{'firstName':'First%d' %i, 'lastName':'Last%d' %i,
+             'email':'employee%d@example.com' %i, 'ssn':'%09d' %i,
+             'gender':random.choice(['F', 'M']), 'city':'Boston',
+             'State':'MA', 'zipCode':'02110', 'title':'Nurse',
+             'birthdate':today - datetime.timedelta(days=9000 + i % 5000),
+             'hiringDate':today - datetime.timedelta(days=i % 3000),
+             'payRate':30.0 + i % 20, 'status':'Active', 'rating':i % 5,
+             'department_id':1} for i in range(count)]
+    session.bulk_insert_mappings(Employee, rows)
+    session.commit()
+
+
+def orm_path(session):
+    employees = session.query(Employee).order_by(Employee.id).all()
+    body = flask_json.dumps({'employees':[i.serialize for i in employees]})
+    session.expunge_all()
+    return len(body)
+
+
+def tuple_path(session):
+    names, query = serializers.select_serialized(
+        session.query(Employee).order_by(Employee.id), Employee)
+    body = serializers.dumps(
+        {'employees':serializers.rows_to_dicts(names, query.all())})
+    return len(body)
+
+
+def measure(label, func, session, count, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        size = func(session)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    print('%-28s %8.3fs %10.0f rows/s %8.1f MB' %(label, best, count / best,
+                                                 size / 1e6))
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    seed(session, count)
+    print('%d employees, json backend: %s' %(
+        count, 'orjson' if serializers.orjson else 'stdlib json'))
+    with Flask(__name__).app_context():
+        slow = measure('orm + serialize + jsonify', orm_path, session, count)
+        fast = measure('tuples + fast serializer', tuple_path, session, count)
+    print('speedup: %.1fx' %(slow / fast))
+
+
+if __name__ == '__main__':
+    main()
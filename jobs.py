@@ -0,0 +1,194 @@
+# lightweight background jobs: a redis list is the queue and every job
+# keeps its state as json under job/<id>. A worker moves the id it takes to
+# a processing list until the job is over, so a job whose worker died is
+# found there and queued again. When redis cannot be reached the job runs
+# on a local thread instead and its state stays in process.
+import json, time, uuid, threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from redis.exceptions import RedisError
+
+
+@contextmanager
+def no_context():
+    yield
+
+
+class JobProgress(object):
+    # handed to the task, lets it report how far it got
+
+    def __init__(self, queue, job, store):
+        self.queue = queue
+        self.job = job
+        self.store = store
+
+    def __call__(self, done, total=None):
+        if total:
+            done = int(done * 100 / total)
+        self.job['progress'] = max(0, min(100, done))
+        self.job['updatedAt'] = time.time()
+        self.store(self.job)
+
+
+class JobQueue(object):
+
+    def __init__(self, redis, context=None, name='jobs', ttl=24*3600,
+                 max_retries=3, local_workers=2, logger=None, stale_after=600):
+        # context: returns a context manager every job runs in
+        # stale_after: seconds without progress after which a job taken by
+        # a worker is considered lost with its worker
+        self.redis = redis
+        self.context = context or no_context
+        self.name = name
+        self.ttl = ttl
+        self.max_retries = max_retries
+        self.stale_after = stale_after
+        self.logger = logger
+        self.tasks = {}
+        self.local_jobs = {}
+        self.local_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=local_workers)
+
+    def task(self, name=None):
+        # register a function as a job, called as f(progress, **payload)
+        def decorator(f):
+            self.tasks[name or f.__name__] = f
+            return f
+        return decorator
+
+    def key(self, job_id):
+        return '%s/%s' %(self.name, job_id)
+
+    def store_redis(self, job):
+        self.redis.setex(self.key(job['id']), self.ttl, json.dumps(job))
+
+    def store_local(self, job):
+        with self.local_lock:
+            self.local_jobs[job['id']] = dict(job)
+
+    def prune_local(self, now):
+        # finished local jobs are kept as long as redis would keep them
+        with self.local_lock:
+            for job_id, job in list(self.local_jobs.items()):
+                if (job['status'] in ('done', 'failed') and
+                        job['updatedAt'] + self.ttl < now):
+                    del self.local_jobs[job_id]
+
+    def enqueue(self, name, payload=None, max_retries=None):
+        if name not in self.tasks:
+            raise ValueError('unknown job %s' %name)
+        now = time.time()
+        job = {'id':uuid.uuid4().hex, 'name':name, 'payload':payload or {},
+               'status':'queued', 'progress':0, 'attempts':0,
+               'maxRetries':self.max_retries if max_retries is None else max_retries,
+               'result':None, 'error':None, 'createdAt':now, 'updatedAt':now}
+        try:
+            self.store_redis(job)
+            self.redis.lpush(self.name + ':queue', job['id'])
+        except RedisError as e:
+            self.log('job %s runs locally, redis failed: %s' %(job['id'], e))
+            job['local'] = True
+            self.prune_local(now)
+            self.store_local(job)
+            self.executor.submit(self.run_local, job['id'])
+        return job['id']
+
+    def get(self, job_id):
+        with self.local_lock:
+            job = self.local_jobs.get(job_id)
+        if job is not None:
+            return job
+        data = self.redis.get(self.key(job_id))
+        return json.loads(data.decode()) if data is not None else None
+
+    def run(self, job, store):
+        # one attempt, the job is queued again while it has retries left
+        job['status'] = 'running'
+        job['attempts'] += 1
+        job['updatedAt'] = time.time()
+        store(job)
+        task = self.tasks.get(job['name'])
+        try:
+            if task is None:
+                raise ValueError('unknown job %s' %job['name'])
+            with self.context():
+                result = task(JobProgress(self, job, store), **job['payload'])
+        except Exception as e:
+            self.log('job %s failed: %r' %(job['id'], e))
+            job['error'] = '%s: %s' %(type(e).__name__, e)
+            retry = task is not None and job['attempts'] <= job['maxRetries']
+            job['status'] = 'queued' if retry else 'failed'
+        else:
+            job['status'] = 'done'
+            job['progress'] = 100
+            job['result'] = result
+            job['error'] = None
+        job['updatedAt'] = time.time()
+        store(job)
+        return job['status'] == 'queued'
+
+    def run_local(self, job_id):
+        with self.local_lock:
+            job = self.local_jobs[job_id]
+        if self.run(job, self.store_local):
+            self.executor.submit(self.run_local, job_id)
+
+    def requeue_stale(self, connection):
+        # jobs left in the processing list by a worker that died: queued
+        # again while they have retries left, failed otherwise
+        queue, processing = self.name + ':queue', self.name + ':processing'
+        now = time.time()
+        for item in connection.lrange(processing, 0, -1):
+            job_id = item.decode()
+            data = connection.get(self.key(job_id))
+            job = json.loads(data.decode()) if data is not None else None
+            if job is not None and now - job['updatedAt'] < self.stale_after:
+                continue
+            # whoever removes it owns it, a worker may just have finished
+            if not connection.lrem(processing, 1, job_id) or job is None:
+                continue
+            self.log('job %s was left %s by its worker' %(job_id, job['status']))
+            job['error'] = 'worker lost'
+            job['updatedAt'] = now
+            if job['attempts'] <= job['maxRetries']:
+                job['status'] = 'queued'
+                connection.setex(self.key(job_id), self.ttl, json.dumps(job))
+                connection.lpush(queue, job_id)
+            else:
+                job['status'] = 'failed'
+                connection.setex(self.key(job_id), self.ttl, json.dumps(job))
+
+    def work(self, connection=None, burst=False, timeout=5):
+        # worker loop; connection needs a socket timeout above `timeout`
+        connection = connection or self.redis
+        queue, processing = self.name + ':queue', self.name + ':processing'
+        checked = 0
+        while True:
+            if time.time() - checked >= min(self.stale_after / 2, 60):
+                self.requeue_stale(connection)
+                checked = time.time()
+            item = connection.brpoplpush(queue, processing, timeout)
+            if item is None:
+                if burst:
+                    return
+                continue
+            job_id = item.decode()
+            data = connection.get(self.key(job_id))
+            if data is None:
+                connection.lrem(processing, 1, job_id)
+                continue
+            job = json.loads(data.decode())
+            store = lambda job: connection.setex(self.key(job['id']), self.ttl,
+                                                 json.dumps(job))
+            retry = self.run(job, store)
+            # back on the queue and off the processing list in one step
+            p = connection.pipeline()
+            if retry:
+                p.lpush(queue, job_id)
+            p.lrem(processing, 1, job_id)
+            p.execute()
+
+    def log(self, message):
+        if self.logger is not None:
+            self.logger.warning(message)
@@ -0,0 +1,115 @@
+# in process metrics rendered in the prometheus text format. Every worker
+# process keeps its own values, prometheus sums them across targets.
+import threading
+
+# seconds, for latency and database time
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{%s}' %','.join('%s="%s"' %(n, str(v).replace('\\', '\\\\')
+                                          .replace('"', '\\"'))
+                            for n, v in zip(names, values))
+
+
+class Counter(object):
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ['# HELP %s %s' %(self.name, self.help),
+                 '# TYPE %s counter' %self.name]
+        with self.lock:
+            items = sorted(self.values.items())
+        for labels, value in items:
+            lines.append('%s%s %s' %(self.name, format_labels(self.labels, labels),
+                                     value))
+        return lines
+
+
+class Gauge(object):
+    # value read when rendering, from a function returning {labels: value};
+    # type can be 'counter' for totals that are counted elsewhere
+
+    def __init__(self, name, help, labels, collect, type='gauge'):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.collect = collect
+        self.type = type
+
+    def render(self):
+        lines = ['# HELP %s %s' %(self.name, self.help),
+                 '# TYPE %s %s' %(self.name, self.type)]
+        for labels, value in sorted(self.collect().items()):
+            lines.append('%s%s %s' %(self.name, format_labels(self.labels, labels),
+                                     value))
+        return lines
+
+
+class Histogram(object):
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        # labels -> [count per bucket..., sum, count]
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            state = self.values.get(labels)
+            if state is None:
+                state = self.values[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[i] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def render(self):
+        lines = ['# HELP %s %s' %(self.name, self.help),
+                 '# TYPE %s histogram' %self.name]
+        with self.lock:
+            items = sorted((k, list(v)) for k, v in self.values.items())
+        names = self.labels + ('le',)
+        for labels, state in items:
+            for bound, count in zip(self.buckets, state):
+                lines.append('%s_bucket%s %s' %(self.name,
+                             format_labels(names, labels + (bound,)), count))
+            lines.append('%s_bucket%s %s' %(self.name,
+                         format_labels(names, labels + ('+Inf',)), state[-1]))
+            lines.append('%s_sum%s %s' %(self.name,
+                         format_labels(self.labels, labels), state[-2]))
+            lines.append('%s_count%s %s' %(self.name,
+                         format_labels(self.labels, labels), state[-1]))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -1,21 +1,75 @@
 from sqlalchemy import Column, ForeignKey, Integer, String, Date, DateTime
-from sqlalchemy import Float, Text, Boolean, Table
+from sqlalchemy import Float, Text, Boolean, Table, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, inspect
 
-from passlib.apps import custom_app_context as pwd_context
+from passwords import PasswordHasher
 from itsdangerous import (TimedJSONWebSignatureSerializer
                           as Serializer, BadSignature, SignatureExpired)
 
-import random, string, datetime
-
-# database config
-from config import DB_USER, DB_PASSWORD, DB_END, DB_PORT, DB_DATABASE
+import random, string, datetime, threading, logging
 
 Base = declarative_base()
+# only used when config.py has no SECRET_KEYS, then every process has its
+# own key and tokens are only valid on the process that issued them
 secret_key = ''.join(random.choice(string.ascii_uppercase +
                                    string.digits) for x in range(32))
+_signing_keys = None
+_password_hasher = None
+
+
+def signing_keys():
+    # SECRET_KEYS in config.py, newest first: the first key signs tokens,
+    # every key verifies them, so an old key can be kept while rotating
+    global _signing_keys
+    if _signing_keys is None:
+        try:
+            import config
+            keys = (getattr(config, 'SECRET_KEYS', None) or
+                    getattr(config, 'SECRET_KEY', None))
+        except ImportError:
+            keys = None
+        if isinstance(keys, str):
+            keys = [keys]
+        if not keys:
+            logging.getLogger(__name__).warning(
+                'no SECRET_KEYS in config.py, tokens are signed with a key '
+                'of this process only and other workers will reject them')
+        _signing_keys = list(keys) if keys else [secret_key]
+    return _signing_keys
+
+
+def configure_signing_keys(keys):
+    # replace the key set at runtime, e.g. after a rotation
+    global _signing_keys
+    _signing_keys = list(keys)
+
+
+def password_hasher():
+    # PASSWORD_SCHEMES (first one hashes), PASSWORD_ROUNDS per scheme and
+    # the pool size in config.py; stored hashes using older settings are
+    # replaced when their password is next verified
+    global _password_hasher
+    if _password_hasher is None:
+        try:
+            import config
+        except ImportError:
+            config = None
+        _password_hasher = PasswordHasher(
+            schemes=getattr(config, 'PASSWORD_SCHEMES', None),
+            rounds=getattr(config, 'PASSWORD_ROUNDS', None),
+            workers=getattr(config, 'PASSWORD_WORKERS', 2),
+            max_pending=getattr(config, 'PASSWORD_MAX_PENDING', 64),
+            wait=getattr(config, 'PASSWORD_WAIT', 5))
+    return _password_hasher
+
+
+def configure_password_hasher(hasher):
+    global _password_hasher
+    if _password_hasher is not None:
+        _password_hasher.shutdown()
+    _password_hasher = hasher
 
 ''' About User'''
 class User(Base):
@@ -29,13 +83,17 @@ class User(Base):
     note = relationship('Note', backref='user')
 
     def hash_password(self, password):
-        self.password_hash = pwd_context.encrypt(password)
+        self.password_hash = password_hasher().hash(password)
 
     def verify_password(self, password):
-        return pwd_context.verify(password, self.password_hash)
+        # an outdated hash is upgraded, the request commits it
+        valid, new_hash = password_hasher().verify(password, self.password_hash)
+        if valid and new_hash:
+            self.password_hash = new_hash
+        return valid
 
     def generate_auth_token(self, expiration=600):
-        s = Serializer(secret_key, expires_in=expiration)
+        s = Serializer(signing_keys()[0], expires_in=expiration)
         return s.dumps({'id':self.id})
 
     def is_active(self):
@@ -49,16 +107,19 @@ class User(Base):
 
     @staticmethod
     def verify_auth_token(token):
-        s = Serializer(secret_key)
-        try:
-            data=s.loads(token)
-        except SignatureExpired:
-            # Valid token but expired
-            return None
-        except BadSignature:
-            return None
-        user_id = data['id']
-        return user_id
+        # the active key first, then the previous ones
+        for key in signing_keys():
+            s = Serializer(key)
+            try:
+                data=s.loads(token)
+            except SignatureExpired:
+                # Valid token but expired
+                return None
+            except BadSignature:
+                continue
+            user_id = data['id']
+            return user_id
+        return None
 
     @property
     def serialize(self):
@@ -111,12 +172,27 @@ class Employee(Base):
     status = Column(String(50), nullable=False, default='Active')
     rating = Column(Integer)
     department_id = Column(Integer, ForeignKey('department.id'))
+    # bumped on every update, used for etags
+    version = Column(Integer, nullable=False, default=1)
     education = relationship('Education', backref='employee')
     note = relationship('Note', backref='employee')
     training = relationship('Training', backref='employee')
     documents = relationship('Documents', backref='employee')
     emergency = relationship('Emergency', backref='employee')
     boarding = relationship('Onboarding', backref='employee')
+    # indexes behind the filters and sorts of the employee list
+    __table_args__ = (
+        Index('ix_employee_department_status_last',
+              'department_id', 'status', 'lastName'),
+        Index('ix_employee_status_hiring', 'status', 'hiringDate'),
+        Index('ix_employee_state_city', 'State', 'city'),
+        Index('ix_employee_last_first', 'lastName', 'firstName'),
+        Index('ix_employee_hiring', 'hiringDate'),
+        # name search, a plain composite index outside of mysql
+        Index('ix_employee_fulltext', 'firstName', 'lastName', 'email',
+              mysql_prefix='FULLTEXT'),
+        )
+    __mapper_args__ = {'version_id_col':version}
 
     @property
     def serialize(self):
@@ -208,7 +284,7 @@ class Training(Base):
     id = Column(Integer, primary_key=True)
     traininglist_id = Column(Integer, ForeignKey('traininglist.id'))
     provided = Column(Date, default=datetime.datetime.utcnow)
-    due = Column(Date)
+    due = Column(Date, index=True)
     employee_id = Column(Integer, ForeignKey('employee.id'))
 
     @property
@@ -284,7 +360,7 @@ class Onboarding(Base):
     __tablename__ = 'onboarding'
     id = Column(Integer, primary_key=True)
     provided = Column(Date, nullable=False)
-    expired = Column(Date, nullable=True)
+    expired = Column(Date, nullable=True, index=True)
     employee_id = Column(Integer, ForeignKey('employee.id'))
     onboardinglist_id = Column(Integer, ForeignKey('onboardinglist.id'))
 
@@ -324,6 +400,12 @@ class Patient(Base):
     State = Column(String(20))
     status = Column(String(50), nullable=False)
     care = relationship('Employee', secondary=linking_members, backref="Patient")
+    # name search
+    __table_args__ = (
+        Index('ix_patient_last_first', 'lastName', 'firstName'),
+        Index('ix_patient_fulltext', 'firstName', 'lastName', 'patientId',
+              mysql_prefix='FULLTEXT'),
+        )
 
     @property
     def serialize(self):
@@ -376,6 +458,80 @@ class CompanyLinks(Base):
             }
 
 
-engine = create_engine('mysql+pymysql://'+DB_USER+':'+DB_PASSWORD+'@'+DB_END+':'+DB_PORT+'/'
-                     +DB_DATABASE)
-Base.metadata.create_all(engine)
+# database engine: one per process, created on first use, so importing the
+# models needs neither the database nor config.py and pre-fork servers
+# open their connections in the workers
+_engine = None
+_engine_url = None
+_engine_options = {}
+_engine_lock = threading.Lock()
+
+
+def database_url():
+    # DATABASE_URL from config.py (e.g. sqlite:///hr.db), else mysql
+    import config
+    url = getattr(config, 'DATABASE_URL', None)
+    if url:
+        return url
+    return ('mysql+pymysql://'+config.DB_USER+':'+config.DB_PASSWORD+'@'
+            +config.DB_END+':'+config.DB_PORT+'/'+config.DB_DATABASE)
+
+
+def engine_options(url):
+    # connection pool config, each can be overridden in config.py
+    import config
+    options = {'pool_pre_ping':getattr(config, 'DB_POOL_PRE_PING', True)}
+    # sqlite has no queue pool to size
+    if not url.startswith('sqlite'):
+        options.update(pool_size=getattr(config, 'DB_POOL_SIZE', 10),
+                       max_overflow=getattr(config, 'DB_MAX_OVERFLOW', 20),
+                       pool_timeout=getattr(config, 'DB_POOL_TIMEOUT', 30),
+                       pool_recycle=getattr(config, 'DB_POOL_RECYCLE', 3600))
+    return options
+
+
+def configure_engine(url=None, **options):
+    # use another database than config.py says, before or after first use
+    global _engine, _engine_url, _engine_options
+    with _engine_lock:
+        if _engine is not None:
+            _engine.dispose()
+        _engine = None
+        _engine_url = url
+        _engine_options = options
+
+
+def get_engine():
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                url = _engine_url or database_url()
+                options = engine_options(url)
+                options.update(_engine_options)
+                _engine = create_engine(url, **options)
+    return _engine
+
+
+def init_db(engine=None):
+    # create missing tables, then bring existing ones up to date
+    engine = engine or get_engine()
+    Base.metadata.create_all(engine)
+    upgrade_db(engine)
+
+
+def upgrade_db(engine):
+    # columns and indexes added to the models after their table was created
+    inspector = inspect(engine)
+    if 'version' not in [c['name'] for c in inspector.get_columns('employee')]:
+        engine.execute('ALTER TABLE employee ADD COLUMN version INTEGER '
+                       'NOT NULL DEFAULT 1')
+    for table in Base.metadata.sorted_tables:
+        existing = set(i['name'] for i in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(engine)
+
+
+if __name__ == '__main__':
+    init_db()
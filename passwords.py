@@ -0,0 +1,100 @@
+# password hashing off the request thread: hash and verify run in a small
+# process pool so a burst of logins keeps at most `workers` cores busy and
+# the threads serving other requests are never stuck on the CPU. Only a
+# bounded number of calls may wait for the pool, past that PasswordBusy is
+# raised and the caller answers 503 instead of piling up.
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from passlib.context import CryptContext
+
+# schemes passlib's custom_app_context wrote, kept so existing hashes verify
+# and get upgraded to the configured scheme on the next login
+LEGACY_SCHEMES = ['sha512_crypt', 'sha256_crypt']
+
+# (schemes, rounds) -> CryptContext, per process
+_contexts = {}
+
+
+class PasswordBusy(Exception):
+    pass
+
+
+def crypt_context(schemes, rounds):
+    # the first scheme hashes new passwords, the others only verify and are
+    # deprecated; rounds below the configured ones are deprecated as well
+    key = (schemes, rounds)
+    context = _contexts.get(key)
+    if context is None:
+        names = list(schemes)
+        for scheme in LEGACY_SCHEMES:
+            if scheme not in names:
+                names.append(scheme)
+        options = {}
+        for scheme, value in rounds:
+            options[scheme + '__default_rounds'] = value
+            options[scheme + '__min_rounds'] = value
+        context = _contexts[key] = CryptContext(
+            schemes=names, default=names[0], deprecated='auto', **options)
+    return context
+
+
+# run in the pool, module level so they can be pickled
+def hash_password(schemes, rounds, password):
+    return crypt_context(schemes, rounds).hash(password)
+
+
+def verify_password(schemes, rounds, password, password_hash):
+    # (valid, new hash or None when the stored one is up to date)
+    return crypt_context(schemes, rounds).verify_and_update(password,
+                                                            password_hash)
+
+
+class PasswordHasher(object):
+
+    def __init__(self, schemes=None, rounds=None, workers=2, max_pending=64,
+                 wait=5):
+        # workers: processes in the pool, 0 hashes on the calling thread
+        # max_pending: calls running or waiting for the pool at once
+        # wait: seconds a call may wait for a slot before PasswordBusy
+        self.schemes = tuple(schemes or LEGACY_SCHEMES[:1])
+        self.rounds = tuple(sorted((rounds or {}).items()))
+        self.workers = workers
+        self.wait = wait
+        self.slots = threading.BoundedSemaphore(max(max_pending, 1))
+        self.pool = None
+        self.lock = threading.Lock()
+
+    def executor(self):
+        # started on first use, after the server forked its workers; spawned
+        # rather than forked since the parent runs threads
+        with self.lock:
+            if self.pool is None:
+                self.pool = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'))
+            return self.pool
+
+    def run(self, func, *args):
+        args = (self.schemes, self.rounds) + args
+        if not self.workers:
+            return func(*args)
+        if not self.slots.acquire(timeout=self.wait):
+            raise PasswordBusy('too many password checks waiting')
+        try:
+            return self.executor().submit(func, *args).result()
+        finally:
+            self.slots.release()
+
+    def hash(self, password):
+        return self.run(hash_password, password)
+
+    def verify(self, password, password_hash):
+        return self.run(verify_password, password, password_hash)
+
+    def shutdown(self):
+        with self.lock:
+            if self.pool is not None:
+                self.pool.shutdown()
+                self.pool = None
@@ -0,0 +1,202 @@
+# column level serialization for the read endpoints: columns are selected
+# as plain tuples (no ORM objects, no identity map), optionally only the
+# ones asked for with ?fields=, and encoded with orjson when it is
+# installed. dumps writes dates exactly as flask's jsonify does (an HTTP
+# date such as "Tue, 02 Jan 2024 00:00:00 GMT"), so the fast path does
+# not change what clients get.
+import csv, datetime, decimal, io, json
+
+from werkzeug.http import http_date
+from sqlalchemy import Integer, Float, Date, DateTime, Boolean
+from models import User, Department, Employee, Company, CompanyLinks
+from models import Traininglist, Onboardinglist, Education, Note
+from models import Emergency, Training, Onboarding
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+
+# same keys as the models serialize property, id always comes first
+SERIALIZED_COLUMNS = {
+    User:[('id', User.id), ('email', User.email), ('title', User.title)],
+    Department:[('id', Department.id), ('name', Department.name),
+                ('description', Department.description)],
+    Employee:[('id', Employee.id), ('picture', Employee.picture),
+              ('firstName', Employee.firstName),
+              ('lastName', Employee.lastName),
+              ('middleName', Employee.middleName),
+              ('birthdate', Employee.birthdate), ('email', Employee.email),
+              ('ssn', Employee.ssn), ('gender', Employee.gender),
+              ('homePhone', Employee.homePhone),
+              ('cellPhone', Employee.cellPhone),
+              ('address', Employee.address), ('city', Employee.city),
+              ('zipCode', Employee.zipCode), ('State', Employee.State),
+              ('hiringDate', Employee.hiringDate), ('title', Employee.title),
+              ('payRate', Employee.payRate), ('status', Employee.status),
+              ('rating', Employee.rating),
+              ('departmentId', Employee.department_id)],
+    Company:[('id', Company.id), ('name', Company.name)],
+    CompanyLinks:[('id', CompanyLinks.id), ('name', CompanyLinks.name),
+                  ('link', CompanyLinks.link)],
+    Traininglist:[('id', Traininglist.id), ('name', Traininglist.name),
+                  ('description', Traininglist.description)],
+    Onboardinglist:[('id', Onboardinglist.id), ('name', Onboardinglist.name),
+                    ('description', Onboardinglist.description)],
+    Education:[('id', Education.id), ('institution', Education.institution),
+               ('major', Education.major), ('start', Education.start),
+               ('end', Education.end), ('employeeId', Education.employee_id)],
+    Note:[('id', Note.id), ('body', Note.body), ('user_id', Note.user_id),
+          ('employeeId', Note.employee_id)],
+    Emergency:[('id', Emergency.id), ('firstName', Emergency.firstName),
+               ('lastName', Emergency.lastName),
+               ('homePhone', Emergency.homePhone),
+               ('cellPhone', Emergency.cellPhone),
+               ('employeeId', Emergency.employee_id)],
+    Training:[('id', Training.id), ('provided', Training.provided),
+              ('due', Training.due),
+              ('trainingListID', Training.traininglist_id),
+              ('employeeId', Training.employee_id)],
+    Onboarding:[('id', Onboarding.id), ('provided', Onboarding.provided),
+                ('expired', Onboarding.expired),
+                ('onboardingListId', Onboarding.onboardinglist_id),
+                ('employeeId', Onboarding.employee_id)]
+    }
+
+
+def encode_default(obj):
+    # what the stdlib encoder does not know about, dates as flask does
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return http_date(obj.timetuple())
+    if isinstance(obj, decimal.Decimal):
+        return float(obj)
+    raise TypeError('%r is not JSON serializable' %obj)
+
+
+def dumps(obj):
+    # always returns bytes
+    if orjson is not None:
+        # orjson writes dates itself unless they are passed to default
+        return orjson.dumps(obj, default=encode_default,
+                            option=orjson.OPT_PASSTHROUGH_DATETIME)
+    return json.dumps(obj, default=encode_default,
+                      separators=(',', ':')).encode('utf-8')
+
+
+def supports(model):
+    return model in SERIALIZED_COLUMNS
+
+
+def column_names(model):
+    return [name for name, column in SERIALIZED_COLUMNS[model]]
+
+
+def select_serialized(query, model, fields=None):
+    # turn a query of model into a query of the serialized columns, or of
+    # the given subset of them; filters and ordering are kept
+    columns = dict(SERIALIZED_COLUMNS[model])
+    names = fields or column_names(model)
+    return names, query.with_entities(*[columns[name] for name in names])
+
+
+def rows_to_dicts(names, rows):
+    return [dict(zip(names, row)) for row in rows]
+
+
+# export formats: each yields bytes chunk by chunk from an iterable of
+# tuples, so the full result is never held in memory
+def chunked(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_chunks(names, rows, size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(names)
+    for chunk in chunked(rows, size):
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode('utf-8')
+
+
+def jsonl_chunks(names, rows, size):
+    for chunk in chunked(rows, size):
+        yield b''.join(dumps(dict(zip(names, row))) + b'\n' for row in chunk)
+
+
+class ChunkSink(object):
+    # write-only file for pyarrow that hands back what was written so far,
+    # tell() keeps counting so the parquet footer offsets stay right
+    closed = False
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def arrow_type(column):
+    if isinstance(column.type, Integer):
+        return pyarrow.int64()
+    if isinstance(column.type, Float):
+        return pyarrow.float64()
+    if isinstance(column.type, DateTime):
+        return pyarrow.timestamp('us')
+    if isinstance(column.type, Date):
+        return pyarrow.date32()
+    if isinstance(column.type, Boolean):
+        return pyarrow.bool_()
+    return pyarrow.string()
+
+
+def parquet_chunks(model, names, rows, size):
+    # one row group per chunk, needs pyarrow
+    columns = dict(SERIALIZED_COLUMNS[model])
+    schema = pyarrow.schema([(name, arrow_type(columns[name])) for name in names])
+    sink = ChunkSink()
+    writer = pyarrow.parquet.ParquetWriter(pyarrow.PythonFile(sink, mode='w'),
+                                           schema)
+    for chunk in chunked(rows, size):
+        table = pyarrow.Table.from_arrays(
+            [pyarrow.array(values, type=field.type)
+             for values, field in zip(zip(*chunk), schema)], schema=schema)
+        writer.write_table(table)
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()